@@ -1,7 +1,6 @@
 import os
 
-from celery import Celery, chord
-from kombu import uuid
+from celery import Celery
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'TTSG.settings')
 
@@ -15,15 +14,14 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Chargement des taches automatiquement depuis les apps django enregitrées.
 app.autodiscover_tasks()
 
+# Les tâches sont réparties sur deux files (CELERY_TASK_ROUTES dans settings.py), chacune avec ses workers :
+#   celery -A TTSG worker -Q interactive -n interactive@%h -c 2
+#       encodage des photos des demandes, recherche et mails : peu de tâches, qu'un utilisateur attend
+#   celery -A TTSG worker -Q bulk -n bulk@%h -c <nombre de coeurs>
+#       indexation des répertoires et préparation des archives : des milliers de tâches longues
+#   celery -A TTSG beat
+# Un même worker peut écouter les deux files (-Q interactive,bulk) s'il n'y a qu'une machine, mais il alterne alors
+# entre les files : une demande peut attendre la fin des tâches d'indexation en cours sur tous ses processus.
+# Attention : un worker lancé sans -Q n'écoute que la file par défaut (interactive), les tâches de la file bulk ne
+# sont alors jamais exécutées et l'indexation reste bloquée.
 
-class ProgressChord(chord):
-
-    def __call__(self, body=None, **kwargs):
-        _chord = self.type
-        body = (body or self.kwargs['body']).clone()
-        kwargs = dict(self.kwargs, body=body, **kwargs)
-        if _chord.app.conf.CELERY_ALWAYS_EAGER:
-            return self.apply((), kwargs)
-        callback_id = body.options.setdefault('task_id', uuid())
-        r = _chord(**kwargs)
-        return _chord.AsyncResult(callback_id), r
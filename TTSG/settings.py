@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
+from datetime import timedelta
 from os import getenv
 from pathlib import Path
 
@@ -184,6 +185,20 @@ CELERY_ACCEPT_CONTENT = ['pickle', 'json']
 CELERY_TASK_SERIALIZER = "pickle"
 CELERY_RESULT_SERIALIZER = "pickle"
 CELERY_EVENT_SERIALIZER = "pickle"
+# Deux files : "interactive" pour le travail qu'un utilisateur attend (encodage des demandes, recherche, mails) et
+# "bulk" pour l'indexation des répertoires, pour que les demandes ne restent pas bloquées derrière des milliers de
+# tâches d'indexation. Chaque file doit avoir ses propres workers (voir TTSG/celery.py).
+CELERY_TASK_DEFAULT_QUEUE = "interactive"
+CELERY_TASK_ROUTES = {
+    "facereco.tasks.task_indexing_directory": {"queue": "bulk"},
+    "facereco.tasks.task_face_encoding_chunk": {"queue": "bulk"},
+    "facereco.tasks.task_indexing_ending": {"queue": "bulk"},
+    "facereco.tasks.task_build_demand_archive": {"queue": "bulk"},
+    "facereco.tasks.task_evict_encoding_cache": {"queue": "bulk"},
+}
+# Les tâches sont longues : un worker ne réserve pas de tâches d'avance, qui attendraient derrière la tâche en cours
+# alors qu'un autre worker est libre
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
 
 # Face recognition settings
@@ -192,13 +207,77 @@ WITH_FACE_RECOGNITION = getenv("WITH_FACE_RECOGNITION", "False") == "True"
 
 NUM_JITTERS = int(getenv("NUM_JITTERS", 1))
 FACE_RECOGNITION_MODEL = getenv("FACE_RECOGNITION_MODEL", "small")
+# Les images sont décodées avec un plus grand côté d'au plus FACE_ENCODING_MAX_SIZE pixels (0 : taille réelle) et les
+# visages sont détectés sur une copie d'au plus FACE_DETECTION_MAX_SIZE pixels (0 : même taille). Si aucun visage n'est
+# trouvé, la détection est refaite sur l'image agrandie quand FACE_DETECTION_UPSAMPLE_RETRY vaut True.
+FACE_ENCODING_MAX_SIZE = int(getenv("FACE_ENCODING_MAX_SIZE", 3000))
+FACE_DETECTION_MAX_SIZE = int(getenv("FACE_DETECTION_MAX_SIZE", 1600))
+FACE_DETECTION_UPSAMPLE_RETRY = getenv("FACE_DETECTION_UPSAMPLE_RETRY", "False") == "True"
+# Les photos des demandes sont redressées et réduites à DEMAND_PHOTO_MAX_SIZE pixels dès l'envoi. Avec
+# DEMAND_PHOTO_FACE_CHECK, les photos sans visage sont refusées par le formulaire.
+DEMAND_PHOTO_MAX_SIZE = int(getenv("DEMAND_PHOTO_MAX_SIZE", 1600))
+DEMAND_PHOTO_FACE_CHECK = getenv("DEMAND_PHOTO_FACE_CHECK", "True") == "True"
+# Nombre maximal d'entrées du cache des visages encodés, indexé par le contenu des images (0 pour le désactiver)
+ENCODING_CACHE_MAX_ENTRIES = int(getenv("ENCODING_CACHE_MAX_ENTRIES", 500000))
 
 FACE_SEARCHING_BATCH_SIZE = int(getenv("FACE_SEARCHING_BATCH_SIZE", 20))
 INDEXING_CHUNK_SIZE = int(getenv("INDEXING_CHUNK_SIZE", 30))
+# Nombre d'images décodées à l'avance par chaque tâche d'indexation (0 : pas de décodage en parallèle) et mémoire
+# maximale occupée par ces images
+INDEXING_PREFETCH_DEPTH = int(getenv("INDEXING_PREFETCH_DEPTH", 2))
+INDEXING_PREFETCH_MAX_MB = int(getenv("INDEXING_PREFETCH_MAX_MB", 256))
 FACE_SEARCHING_CHUNK_SIZE = int(getenv("FACE_SEARCHING_CHUNK_SIZE", 30))
+# Découpage adaptatif : la taille des tâches de recherche et d'indexation est ajustée d'après leur débit mesuré pour
+# qu'elles durent environ TARGET_SHARD_DURATION secondes. Les tailles ci-dessus servent tant qu'il n'y a pas de mesure.
+ADAPTIVE_SHARDING = getenv("ADAPTIVE_SHARDING", "True") == "True"
+TARGET_SHARD_DURATION = int(getenv("TARGET_SHARD_DURATION", 60))
 FACE_MATCHING_THRESHOLD = float(getenv("FACE_MATCHING_THRESHOLD", 0.5))
+# Recherche vectorisée : tous les visages du répertoire sont comparés en une seule tâche, par blocs de
+# FACE_SEARCHING_BLOCK_SIZE visages
+VECTORIZED_SEARCH = getenv("VECTORIZED_SEARCH", "True") == "True"
+FACE_SEARCHING_BLOCK_SIZE = int(getenv("FACE_SEARCHING_BLOCK_SIZE", 4096))
+# Dossier où sont écrits les index sur disque des visages encodés de chaque répertoire
+ENCODING_INDEX_PATH = getenv("ENCODING_INDEX_PATH", str(BASE_DIR / "encoding_index"))
+# Index approximatif (IVF) construit pour les répertoires d'au moins ANN_MIN_FACES visages (0 pour le désactiver).
+# ANN_NLIST cellules (0 : 4 * racine du nombre de visages), ANN_NPROBE cellules explorées par visage recherché
+# (0 : recherche exhaustive). La commande ann_recall_report permet de choisir ANN_NPROBE.
+ANN_MIN_FACES = int(getenv("ANN_MIN_FACES", 100000))
+ANN_NLIST = int(getenv("ANN_NLIST", 0))
+ANN_NPROBE = int(getenv("ANN_NPROBE", 16))
+ANN_KMEANS_ITERATIONS = int(getenv("ANN_KMEANS_ITERATIONS", 10))
+
+# Cache des archives des demandes traitées (0 pour le désactiver). ARCHIVE_SENDFILE_HEADER peut valoir
+# "X-Accel-Redirect" (nginx, avec une location interne ARCHIVE_SENDFILE_URL_PREFIX qui pointe sur ARCHIVE_CACHE_PATH)
+# ou "X-Sendfile" (Apache) pour que le serveur web envoie les archives à la place de Django.
+ARCHIVE_CACHE_PATH = getenv("ARCHIVE_CACHE_PATH", str(BASE_DIR / "archive_cache"))
+ARCHIVE_CACHE_MAX_SIZE_MB = int(getenv("ARCHIVE_CACHE_MAX_SIZE_MB", 20000))
+ARCHIVE_SENDFILE_HEADER = getenv("ARCHIVE_SENDFILE_HEADER", "")
+ARCHIVE_SENDFILE_URL_PREFIX = getenv("ARCHIVE_SENDFILE_URL_PREFIX", "/protected/archives/")
+# Miniatures des photos créées pendant l'indexation pour la galerie des demandes (THUMBNAIL_SIZE à 0 pour les
+# désactiver). THUMBNAIL_FORMAT vaut "WEBP" ou "JPEG".
+THUMBNAIL_PATH = getenv("THUMBNAIL_PATH", str(BASE_DIR / "thumbnails"))
+THUMBNAIL_SIZE = int(getenv("THUMBNAIL_SIZE", 400))
+THUMBNAIL_FORMAT = getenv("THUMBNAIL_FORMAT", "WEBP")
+GALLERY_PAGE_SIZE = int(getenv("GALLERY_PAGE_SIZE", 48))
 MIN_TIME_BETWEEN_DEMANDS = int(getenv("MIN_TIME_BETWEEN_DEMANDS", 10))
 MAX_WAITING_TIME_BEFORE_SEARCH = int(getenv("MAX_WAITING_TIME_BEFORE_SEARCH", 20))
+# Délai minimal en secondes entre deux recherches d'un même répertoire, sauf pour les demandes qui attendent depuis
+# MAX_WAITING_TIME_BEFORE_SEARCH minutes
+SEARCH_DEBOUNCE_TIME = int(getenv("SEARCH_DEBOUNCE_TIME", 60))
+# Une recherche ou une indexation dont aucune tâche ne s'est terminée depuis STALLED_TASKS_TIMEOUT minutes est
+# considérée comme bloquée (worker tué, message perdu) : ses tâches restantes sont comptées en échec et elle est terminée.
+# Doit rester plus grand que la durée maximale d'une tâche (CELERY_TASK_TIME_LIMIT) et que l'attente dans les files.
+STALLED_TASKS_TIMEOUT = int(getenv("STALLED_TASKS_TIMEOUT", 180))
+# Mail envoyé toutes les NEW_PHOTOS_NOTIFICATION_INTERVAL minutes aux demandes traitées pour lesquelles de nouvelles
+# photos ont été trouvées pendant une indexation
+NEW_PHOTOS_NOTIFICATION = getenv("NEW_PHOTOS_NOTIFICATION", "False") == "True"
+NEW_PHOTOS_NOTIFICATION_INTERVAL = int(getenv("NEW_PHOTOS_NOTIFICATION_INTERVAL", 60))
+# Mesure du temps passé dans chaque étape de l'indexation et de la recherche, exposée au format Prometheus sur /metrics/
+METRICS_ENABLED = getenv("METRICS_ENABLED", "False") == "True"
+# Les mails de fin de recherche sont envoyés par paquets de NOTIFICATION_CHUNK_SIZE demandes, une connexion par paquet.
+# NOTIFICATION_RATE_LIMIT limite le nombre de paquets envoyés par worker (syntaxe Celery, ex : "10/m", vide : sans limite)
+NOTIFICATION_CHUNK_SIZE = int(getenv("NOTIFICATION_CHUNK_SIZE", 50))
+NOTIFICATION_RATE_LIMIT = getenv("NOTIFICATION_RATE_LIMIT", "")
 
 
 
@@ -207,4 +286,16 @@ CELERY_BEAT_SCHEDULE = {
         "task": "facereco.tasks.task_check_if_search_photos_needed",
         "schedule": crontab(minute="*/5"),
     },
+    "notify_new_photos": {
+        "task": "facereco.tasks.task_notify_new_photos",
+        "schedule": timedelta(minutes=NEW_PHOTOS_NOTIFICATION_INTERVAL),
+    },
+    "release_stalled_tasks": {
+        "task": "facereco.tasks.task_release_stalled_tasks",
+        "schedule": crontab(minute="*/15"),
+    },
+    "evict_encoding_cache": {
+        "task": "facereco.tasks.task_evict_encoding_cache",
+        "schedule": crontab(minute="0"),
+    },
 }
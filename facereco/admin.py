@@ -1,10 +1,12 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
 # Register your models here.
 from django.shortcuts import render
 from django.template.loader import render_to_string
 
+from .encoding_index import delete_directory_index
 from .models import Demand, Directory, Photo
+from .tasks import start_indexing
 
 @admin.action(description='Reset demand search')
 def reset_demand_search(self, request, queryset):
@@ -29,7 +31,8 @@ class DemandAdmin(admin.ModelAdmin):
     search_fields = ('id', 'name', 'first_name', 'email', 'directory__name')
 
     list_display = ('name', 'first_name', 'email', 'directory', 'processing_status', 'date')
-    readonly_fields = ('id', 'date', 'request_token', 'face_encoding', 'search_task_id', 'rerunEncoding_button')
+    list_select_related = ('directory',)
+    readonly_fields = ('id', 'date', 'request_token', 'search_task_id', 'rerunEncoding_button')
     list_filter = ('processing_status', 'directory')
 
     actions = [reset_demand_search]
@@ -39,7 +42,18 @@ class DemandAdmin(admin.ModelAdmin):
 def reset_directory(self, request, queryset):
     photos = Photo.objects.filter(directory__in=queryset)
     photos.delete()
-    queryset.update(indexing_task_id=None, total_photos=0, last_indexing_date=None)
+    queryset.update(indexing_task_id=None, total_photos=0, processed_photos=0, failed_photos=0,
+                    indexing_pending_chunks=0, last_indexing_date=None)
+    for dir_id in queryset.values_list('pk', flat=True):
+        delete_directory_index(dir_id)
+
+
+@admin.action(description='Full reindex directory')
+def full_reindex_directory(self, request, queryset):
+    for directory in queryset:
+        # Comme pour l'indexation lancée depuis le bouton, on ne supprime pas les photos d'une indexation en cours
+        if not start_indexing(directory.id, full_rebuild=True):
+            self.message_user(request, f"{directory.name} : indexing in progress", messages.WARNING)
 
 
 @admin.register(Directory)
@@ -59,20 +73,22 @@ class DirectoryAdmin(admin.ModelAdmin):
 
     index_button.short_description = 'indexing'
 
-    list_display = ('name', 'path', 'is_visible', 'total_photos', 'index_button', 'indexing_status',
-                    'last_indexing_date')
+    # L'état d'indexation est calculé à partir des compteurs du répertoire : aucune requête supplémentaire par ligne
+    list_display = ('name', 'path', 'is_visible', 'total_photos', 'processed_photos', 'failed_photos', 'index_button',
+                    'indexing_status', 'last_indexing_date')
 
-    readonly_fields = ('indexing_task_id', 'total_photos', 'indexed_photos', 'indexing_status', 'last_indexing_date',
-                       'index_button', 'force_search_button',)
+    readonly_fields = ('indexing_task_id', 'total_photos', 'processed_photos', 'failed_photos', 'indexing_status',
+                       'last_indexing_date', 'index_button', 'force_search_button',)
 
-    actions = [reset_directory]
+    actions = [reset_directory, full_reindex_directory]
     search_fields = ('name', 'path')
 
 
 @admin.register(Photo)
 class PhotoAdmin(admin.ModelAdmin):
-    list_display = ('directory', 'path')
-    readonly_fields = ('face_encodings', 'path', 'directory')
+    list_display = ('directory', 'path', 'face_count')
+    list_select_related = ('directory',)
+    readonly_fields = ('face_count', 'path', 'directory')
     search_fields = ('id', 'directory__name', 'path')
 
     list_filter = ('directory',)
@@ -0,0 +1,112 @@
+"""
+Index approximatif (IVF) des visages encodés d'un répertoire, pour les très gros répertoires.
+
+Les visages sont répartis dans ANN_NLIST cellules par un k-means. Pour chaque demande, on ne compare le visage
+recherché qu'aux visages des ANN_NPROBE cellules dont le centre est le plus proche, avec la même distance exacte et le
+même seuil que la recherche exhaustive. Le résultat est donc un sous-ensemble des correspondances exactes : plus
+ANN_NPROBE est grand, plus on se rapproche de la recherche exhaustive (voir la commande ann_recall_report).
+"""
+import math
+
+import numpy
+
+# Nombre de points d'entraînement du k-means par cellule
+KMEANS_POINTS_PER_CELL = 64
+
+# Nombre de visages traités à la fois lors de l'affectation aux cellules
+ASSIGNMENT_BLOCK_SIZE = 8192
+
+
+def _assign_to_cells(encodings, centroids):
+    """Renvoie pour chaque visage l'indice de la cellule dont le centre est le plus proche."""
+    centroids = centroids.astype(numpy.float64)
+    centroids_squared_norms = numpy.einsum('ij,ij->i', centroids, centroids)
+
+    assignment = numpy.empty(len(encodings), dtype=numpy.int64)
+    for start in range(0, len(encodings), ASSIGNMENT_BLOCK_SIZE):
+        block = encodings[start:start + ASSIGNMENT_BLOCK_SIZE].astype(numpy.float64)
+        # ||x||² est le même pour toutes les cellules, il n'intervient pas dans le argmin
+        assignment[start:start + len(block)] = numpy.argmin(centroids_squared_norms[None, :] - 2 * block @ centroids.T,
+                                                            axis=1)
+    return assignment
+
+
+def train_kmeans(encodings, nlist, iterations, seed=0):
+    """Calcule les centres de nlist cellules par un k-means sur un échantillon des visages."""
+    rng = numpy.random.default_rng(seed)
+
+    sample_size = min(len(encodings), nlist * KMEANS_POINTS_PER_CELL)
+    sample = numpy.asarray(encodings[numpy.sort(rng.choice(len(encodings), sample_size, replace=False))],
+                           dtype=numpy.float64)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = _assign_to_cells(sample, centroids)
+        counts = numpy.bincount(assignment, minlength=nlist)
+
+        # Somme des visages de chaque cellule : on trie l'échantillon par cellule puis on somme chaque tranche
+        order = numpy.argsort(assignment, kind='stable')
+        non_empty = counts > 0
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))[non_empty]
+        centroids[non_empty] = numpy.add.reduceat(sample[order], starts, axis=0) / counts[non_empty, None]
+
+        # Les cellules vides sont réinitialisées sur des visages pris au hasard
+        empty_cells = numpy.nonzero(~non_empty)[0]
+        if len(empty_cells) > 0:
+            centroids[empty_cells] = sample[rng.choice(sample_size, len(empty_cells), replace=False)]
+
+    return centroids.astype(numpy.float32)
+
+
+def build_ann_index(encodings, nlist, iterations):
+    """
+    Construit l'index IVF des visages encodés.
+
+    Renvoie un tuple (centroids, ivf_offsets, ivf_faces) : les visages de la cellule c sont les lignes
+    ivf_faces[ivf_offsets[c]:ivf_offsets[c + 1]] de la matrice encodings.
+    """
+    if nlist == 0:
+        nlist = int(4 * math.sqrt(len(encodings)))
+    nlist = max(1, min(nlist, len(encodings)))
+
+    centroids = train_kmeans(encodings, nlist, iterations)
+    assignment = _assign_to_cells(encodings, centroids)
+
+    ivf_faces = numpy.argsort(assignment, kind='stable').astype(numpy.int64)
+    ivf_offsets = numpy.zeros(nlist + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(assignment, minlength=nlist), out=ivf_offsets[1:])
+
+    return centroids, ivf_offsets, ivf_faces
+
+
+def find_candidates(demand_encoding, ann_index, nprobe):
+    """Renvoie les indices (triés) des visages des nprobe cellules les plus proches du visage recherché."""
+    centroids, ivf_offsets, ivf_faces = ann_index
+    nprobe = min(nprobe, len(centroids))
+
+    centroids_distances = numpy.linalg.norm(centroids - demand_encoding, axis=1)
+    nearest_cells = numpy.argpartition(centroids_distances, nprobe - 1)[:nprobe]
+
+    candidates = numpy.concatenate([ivf_faces[ivf_offsets[cell]:ivf_offsets[cell + 1]] for cell in nearest_cells])
+    # Les visages sont lus dans l'ordre de la matrice pour profiter de la lecture séquentielle du fichier mappé
+    candidates.sort()
+    return candidates
+
+
+def find_matches_ann(demands_encodings, faces_encodings, faces_photo_ids, ann_index, nprobe, tolerance):
+    """
+    Même chose que matching.find_matches, en ne comparant chaque visage recherché qu'aux visages des nprobe cellules
+    les plus proches.
+    """
+    matches = set()
+    for demand_index, demand_encoding in enumerate(demands_encodings):
+        demand_encoding = numpy.asarray(demand_encoding, dtype=numpy.float64)
+        candidates = find_candidates(demand_encoding, ann_index, nprobe)
+        if len(candidates) == 0:
+            continue
+
+        distances = numpy.linalg.norm(faces_encodings[candidates].astype(numpy.float64) - demand_encoding, axis=1)
+        for face_index in candidates[distances <= tolerance]:
+            matches.add((demand_index, int(faces_photo_ids[face_index])))
+
+    return sorted(matches)
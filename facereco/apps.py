@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class FacerecoConfig(AppConfig):
     name = "facereco"
+
+    def ready(self):
+        from . import signals
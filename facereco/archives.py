@@ -0,0 +1,155 @@
+import glob
+import hashlib
+import os
+import uuid
+import zipfile
+
+from django.conf import settings
+
+# Taille des blocs lus dans les photos et envoyés au client
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+
+class _ZipStream:
+    """
+    Flux en écriture seule dans lequel zipfile écrit l'archive.
+
+    Il n'a pas de méthode tell : zipfile le considère comme non positionnable et écrit l'archive en une seule passe
+    (avec un descripteur de données après chaque fichier). Le générateur récupère ce qui a été écrit au fur et à mesure.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(paths):
+    """
+    Génère une archive zip des fichiers paths, bloc par bloc, sans jamais la garder entièrement en mémoire.
+
+    Les photos sont déjà compressées, elles sont donc stockées telles quelles (ZIP_STORED). Les fichiers qui n'existent
+    plus sont ignorés.
+    """
+    stream = _ZipStream()
+    arcnames = set()
+
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        for path in paths:
+            try:
+                photo_file = open(path, 'rb')
+            except OSError:
+                continue
+
+            with photo_file:
+                # Deux photos de sous-dossiers différents peuvent avoir le même nom
+                arcname = os.path.basename(path)
+                name, extension = os.path.splitext(arcname)
+                suffix = 1
+                while arcname in arcnames:
+                    arcname = f"{name}_{suffix}{extension}"
+                    suffix += 1
+                arcnames.add(arcname)
+
+                zip_info = zipfile.ZipInfo.from_file(path, arcname)
+                zip_info.compress_type = zipfile.ZIP_STORED
+                with zip_file.open(zip_info, 'w') as zip_entry:
+                    while True:
+                        chunk = photo_file.read(ARCHIVE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        zip_entry.write(chunk)
+                        yield stream.pop()
+            yield stream.pop()
+
+    # Répertoire central de l'archive
+    yield stream.pop()
+
+
+# Cache des archives des demandes traitées.
+#
+# L'archive d'une demande est construite une seule fois en tâche de fond et stockée dans ARCHIVE_CACHE_PATH, sous un
+# nom qui dépend de la demande et des photos trouvées : si les photos de la demande changent, l'ancienne archive
+# n'est plus utilisée. La taille totale du cache est bornée par ARCHIVE_CACHE_MAX_SIZE_MB, les archives les moins
+# récemment téléchargées sont supprimées en premier.
+
+
+def archive_cache_enabled():
+    return settings.ARCHIVE_CACHE_MAX_SIZE_MB > 0
+
+
+def archive_path(demand_id, photos_ids):
+    digest = hashlib.sha256(",".join(str(photo_id) for photo_id in sorted(photos_ids)).encode()).hexdigest()
+    return os.path.join(settings.ARCHIVE_CACHE_PATH, f"{demand_id}-{digest[:32]}.zip")
+
+
+def get_cached_archive(demand_id, photos_ids):
+    """Renvoie le chemin de l'archive en cache de la demande, ou None si elle n'a pas encore été construite."""
+    if not archive_cache_enabled():
+        return None
+
+    path = archive_path(demand_id, photos_ids)
+    try:
+        # La date de modification sert de date de dernier accès pour l'éviction
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def build_archive(demand_id, photos_ids, photos_paths):
+    """Construit l'archive de la demande dans le cache, remplace les anciennes archives de la demande."""
+    path = archive_path(demand_id, photos_ids)
+    os.makedirs(settings.ARCHIVE_CACHE_PATH, exist_ok=True)
+
+    # L'archive est écrite dans un fichier temporaire puis renommée : un téléchargement ne voit jamais une archive
+    # incomplète
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as archive_file:
+        for chunk in iter_zip(photos_paths):
+            archive_file.write(chunk)
+    os.replace(tmp_path, path)
+
+    invalidate_archives(demand_id, keep=path)
+    evict_archives()
+
+    return path
+
+
+def invalidate_archives(demand_id, keep=None):
+    for path in glob.glob(os.path.join(settings.ARCHIVE_CACHE_PATH, f"{demand_id}-*.zip")):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def evict_archives():
+    """Supprime les archives les moins récemment utilisées tant que le cache dépasse sa taille maximale."""
+    archives = []
+    for entry in os.scandir(settings.ARCHIVE_CACHE_PATH):
+        if entry.is_file() and entry.name.endswith(".zip"):
+            entry_stat = entry.stat()
+            archives.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+    max_size = settings.ARCHIVE_CACHE_MAX_SIZE_MB * 1024 * 1024
+    total_size = sum(size for _, size, _ in archives)
+    for _, size, path in sorted(archives):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
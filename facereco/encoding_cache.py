@@ -0,0 +1,85 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .encodings import pack_encodings, unpack_encodings
+from .face_detection import encode_image_file
+from .models import EncodingCache
+
+# Taille des blocs lus pour calculer l'empreinte d'un fichier
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def encoding_cache_enabled():
+    return settings.ENCODING_CACHE_MAX_ENTRIES > 0
+
+
+def _encoding_parameters():
+    # Tous les paramètres qui changent le résultat de la détection et de l'encodage font partie de la clé du cache
+    return "|".join(str(parameter) for parameter in (settings.FACE_RECOGNITION_MODEL, settings.NUM_JITTERS,
+                                                      settings.FACE_ENCODING_MAX_SIZE, settings.FACE_DETECTION_MAX_SIZE,
+                                                      settings.FACE_DETECTION_UPSAMPLE_RETRY))
+
+
+def cache_key(img_path):
+    """Renvoie la clé du cache pour l'image : empreinte de son contenu et des paramètres d'encodage."""
+    digest = hashlib.sha256()
+    with open(img_path, 'rb') as img_file:
+        for chunk in iter(lambda: img_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    digest.update(_encoding_parameters().encode())
+    return digest.hexdigest()
+
+
+def get_cached_faces(keys):
+    """Renvoie un dictionnaire clé -> (face_locations, face_encodings) des clés présentes dans le cache."""
+    cached_faces = {}
+    entries = EncodingCache.objects.filter(key__in=keys).values_list('key', 'face_locations', 'face_encodings_data')
+    for key, face_locations, face_encodings_data in entries:
+        cached_faces[key] = ([tuple(location) for location in face_locations], unpack_encodings(face_encodings_data))
+
+    # La date de dernière utilisation sert à l'éviction des entrées les plus anciennes
+    if len(cached_faces) > 0:
+        EncodingCache.objects.filter(key__in=cached_faces.keys()).update(last_used=timezone.now())
+
+    return cached_faces
+
+
+def store_faces(entries):
+    """Ajoute au cache les tuples (clé, face_locations, face_encodings)."""
+    EncodingCache.objects.bulk_create([
+        EncodingCache(key=key, face_count=len(face_encodings),
+                      face_locations=[list(location) for location in face_locations],
+                      face_encodings_data=pack_encodings(face_encodings))
+        for key, face_locations, face_encodings in entries
+    ], ignore_conflicts=True)
+
+
+def encode_image_file_cached(img_path):
+    """Même chose que face_detection.encode_image_file, en passant par le cache."""
+    if not encoding_cache_enabled():
+        return encode_image_file(img_path)
+
+    key = cache_key(img_path)
+    cached_faces = get_cached_faces([key])
+    if key in cached_faces:
+        return cached_faces[key]
+
+    face_locations, face_encodings = encode_image_file(img_path)
+    store_faces([(key, face_locations, face_encodings)])
+    return face_locations, face_encodings
+
+
+def evict_encoding_cache():
+    """Supprime les entrées les moins récemment utilisées au-delà de ENCODING_CACHE_MAX_ENTRIES."""
+    max_entries = settings.ENCODING_CACHE_MAX_ENTRIES
+    entries = EncodingCache.objects.order_by('-last_used', '-pk').values_list('last_used', 'pk')
+    oldest_kept = entries[max_entries - 1:max_entries]
+    if len(oldest_kept) == 0:
+        return 0
+
+    last_used, pk = oldest_kept[0]
+    deleted, _ = EncodingCache.objects.filter(Q(last_used__lt=last_used) | Q(last_used=last_used, pk__lt=pk)).delete()
+    return deleted
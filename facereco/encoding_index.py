@@ -0,0 +1,139 @@
+"""
+Index des visages encodés d'un répertoire, stocké sur disque.
+
+Pour chaque répertoire, on écrit dans ENCODING_INDEX_PATH/<id du répertoire>/<version>/ :
+- encodings.npy : matrice float32 (nb_visages, 128) de tous les visages encodés du répertoire
+- photo_ids.npy : ids des photos (nb_photos,)
+- offsets.npy : les visages de la photo photo_ids[i] sont les lignes offsets[i] à offsets[i + 1] de la matrice
+Le fichier meta.json du répertoire indique la version courante et la date d'indexation à laquelle elle correspond.
+Les fichiers sont ouverts avec mmap_mode='r' : tous les workers d'une même machine partagent le cache disque.
+"""
+import json
+import os
+import shutil
+import uuid
+
+import numpy
+from django.conf import settings
+
+from .ann_index import build_ann_index
+from .encodings import ENCODING_DTYPE, unpack_encodings
+from .models import Photo
+
+INDEX_META_FILE = "meta.json"
+
+
+def _index_path(dir_id):
+    return os.path.join(settings.ENCODING_INDEX_PATH, str(dir_id))
+
+
+def _indexing_version(directory):
+    if directory.last_indexing_date is None:
+        return None
+    return directory.last_indexing_date.isoformat()
+
+
+def read_directory_encodings(dir_id, first_photo_id=None, last_photo_id=None):
+    """
+    Lit en base tous les visages encodés d'un répertoire, ou seulement ceux des photos dont l'id est compris entre
+    first_photo_id et last_photo_id.
+
+    Renvoie un tuple (encodings, photo_ids, offsets) au même format que l'index sur disque.
+    """
+    photos_ids = []
+    faces_counts = []
+    encodings_data = []
+
+    photos = Photo.objects.filter(directory__pk=dir_id, face_count__gt=0)
+    if first_photo_id is not None:
+        photos = photos.filter(id__gte=first_photo_id)
+    if last_photo_id is not None:
+        photos = photos.filter(id__lte=last_photo_id)
+    for photo_id, face_count, face_encodings_data in photos.values_list('id', 'face_count',
+                                                                        'face_encodings_data').iterator():
+        photos_ids.append(photo_id)
+        faces_counts.append(face_count)
+        encodings_data.append(face_encodings_data)
+
+    # Les données binaires de toutes les photos sont mises bout à bout puis lues en une seule fois
+    encodings = unpack_encodings(b''.join(encodings_data))
+    offsets = numpy.zeros(len(faces_counts) + 1, dtype=numpy.int64)
+    numpy.cumsum(faces_counts, out=offsets[1:])
+
+    return encodings, numpy.array(photos_ids, dtype=numpy.int64), offsets
+
+
+def build_directory_index(directory):
+    """Écrit l'index sur disque des visages encodés du répertoire, pour sa date d'indexation courante."""
+    encodings, photo_ids, offsets = read_directory_encodings(directory.pk)
+
+    index_path = _index_path(directory.pk)
+    version = uuid.uuid4().hex
+    version_path = os.path.join(index_path, version)
+    os.makedirs(version_path)
+
+    numpy.save(os.path.join(version_path, "encodings.npy"), encodings.astype(ENCODING_DTYPE, copy=False))
+    numpy.save(os.path.join(version_path, "photo_ids.npy"), photo_ids)
+    numpy.save(os.path.join(version_path, "offsets.npy"), offsets)
+
+    # Pour les très gros répertoires, on construit aussi l'index approximatif (IVF) des visages
+    with_ann = 0 < settings.ANN_MIN_FACES <= len(encodings)
+    if with_ann:
+        centroids, ivf_offsets, ivf_faces = build_ann_index(encodings, settings.ANN_NLIST,
+                                                            settings.ANN_KMEANS_ITERATIONS)
+        numpy.save(os.path.join(version_path, "centroids.npy"), centroids)
+        numpy.save(os.path.join(version_path, "ivf_offsets.npy"), ivf_offsets)
+        numpy.save(os.path.join(version_path, "ivf_faces.npy"), ivf_faces)
+
+    # Le fichier meta.json est remplacé de manière atomique : un worker qui lit l'index voit soit l'ancienne version,
+    # soit la nouvelle, jamais un index à moitié écrit
+    meta = {"version": version, "indexing_date": _indexing_version(directory), "faces": len(encodings),
+            "ann": with_ann}
+    tmp_meta_path = os.path.join(index_path, INDEX_META_FILE + "." + version)
+    with open(tmp_meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(tmp_meta_path, os.path.join(index_path, INDEX_META_FILE))
+
+    # On supprime les anciennes versions de l'index
+    for entry in os.scandir(index_path):
+        if entry.is_dir() and entry.name != version:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    return len(encodings)
+
+
+def load_directory_index(directory):
+    """
+    Ouvre l'index sur disque du répertoire.
+
+    Renvoie un tuple (encodings, photo_ids, offsets, ann_index) de tableaux en lecture seule, ou None si l'index
+    n'existe pas ou ne correspond pas à la dernière indexation du répertoire. ann_index est le tuple
+    (centroids, ivf_offsets, ivf_faces) de l'index approximatif, ou None s'il n'a pas été construit.
+    """
+    index_path = _index_path(directory.pk)
+    try:
+        with open(os.path.join(index_path, INDEX_META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+
+        if meta["indexing_date"] is None or meta["indexing_date"] != _indexing_version(directory):
+            return None
+
+        version_path = os.path.join(index_path, meta["version"])
+        encodings = numpy.load(os.path.join(version_path, "encodings.npy"), mmap_mode='r')
+        photo_ids = numpy.load(os.path.join(version_path, "photo_ids.npy"), mmap_mode='r')
+        offsets = numpy.load(os.path.join(version_path, "offsets.npy"), mmap_mode='r')
+
+        ann_index = None
+        if meta.get("ann", False):
+            ann_index = (numpy.load(os.path.join(version_path, "centroids.npy")),
+                         numpy.load(os.path.join(version_path, "ivf_offsets.npy"), mmap_mode='r'),
+                         numpy.load(os.path.join(version_path, "ivf_faces.npy"), mmap_mode='r'))
+    except (OSError, ValueError, KeyError):
+        # Index absent, en cours de remplacement ou corrompu : on se rabattra sur la base de données
+        return None
+
+    return encodings, photo_ids, offsets, ann_index
+
+
+def delete_directory_index(dir_id):
+    shutil.rmtree(_index_path(dir_id), ignore_errors=True)
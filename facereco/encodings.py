@@ -0,0 +1,23 @@
+import numpy
+
+# Taille d'un visage encodé par face_recognition
+ENCODING_SIZE = 128
+
+# Les visages encodés sont stockés en binaire, sous forme de float32 contigus
+ENCODING_DTYPE = numpy.float32
+
+
+def pack_encodings(encodings):
+    """Transforme une liste de visages encodés (ou un tableau numpy) en une suite d'octets à stocker en base."""
+    return numpy.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE).tobytes()
+
+
+def unpack_encodings(data):
+    """
+    Renvoie les visages encodés stockés dans data sous forme d'une matrice (nb_visages, 128).
+
+    Le tableau est construit avec numpy.frombuffer : il n'y a pas de copie et il est en lecture seule.
+    """
+    if data is None:
+        return numpy.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+    return numpy.frombuffer(data, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
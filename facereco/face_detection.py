@@ -0,0 +1,148 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from .metrics import timer
+
+if settings.WITH_FACE_RECOGNITION:
+    import face_recognition
+
+
+def load_image(img_path, max_size=0):
+    """
+    Charge l'image en RGB, en la réduisant pour que son plus grand côté ne dépasse pas max_size (0 : taille réelle).
+
+    Pour les JPEG, le mode draft de Pillow décode directement l'image à 1/2, 1/4 ou 1/8 de sa taille, ce qui évite de
+    décoder entièrement les photos de 24 mégapixels.
+    """
+    with timer('decode') as stage:
+        with Image.open(img_path) as image:
+            if max_size > 0:
+                image.draft('RGB', (max_size, max_size))
+            image = image.convert('RGB')
+
+        if max_size > 0 and max(image.size) > max_size:
+            image.thumbnail((max_size, max_size))
+        stage.add(1)
+    return image
+
+
+def load_demand_photo(photo_file, max_size=0):
+    """
+    Charge la photo envoyée avec une demande (fichier ou chemin) en RGB, redressée d'après son orientation EXIF et
+    réduite pour que son plus grand côté ne dépasse pas max_size (0 : taille réelle).
+    """
+    with Image.open(photo_file) as image:
+        if max_size > 0:
+            image.draft('RGB', (max_size, max_size))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    if max_size > 0 and max(image.size) > max_size:
+        image.thumbnail((max_size, max_size))
+    return image
+
+
+def detect_faces(image):
+    """
+    Renvoie les positions (haut, droite, bas, gauche) des visages de l'image (PIL, RGB), détectés sur une copie
+    réduite à FACE_DETECTION_MAX_SIZE, ramenées à la taille de l'image. Si aucun visage n'est trouvé, on peut refaire la
+    détection en agrandissant l'image (FACE_DETECTION_UPSAMPLE_RETRY).
+    """
+    detection_image = image
+    max_size = settings.FACE_DETECTION_MAX_SIZE
+    if max_size > 0 and max(image.size) > max_size:
+        detection_image = image.copy()
+        detection_image.thumbnail((max_size, max_size))
+
+    with timer('detection') as stage:
+        detection_frame = numpy.asarray(detection_image)
+        face_locations = face_recognition.face_locations(detection_frame)
+        if len(face_locations) == 0 and settings.FACE_DETECTION_UPSAMPLE_RETRY:
+            face_locations = face_recognition.face_locations(detection_frame, number_of_times_to_upsample=2)
+        stage.add(1)
+
+    # On ramène les positions à la taille de l'image utilisée pour l'encodage
+    x_scale = image.width / detection_image.width
+    y_scale = image.height / detection_image.height
+    return [(max(0, round(top * y_scale)), min(image.width, round(right * x_scale)),
+             min(image.height, round(bottom * y_scale)), max(0, round(left * x_scale)))
+            for top, right, bottom, left in face_locations]
+
+
+def detect_and_encode(image):
+    """
+    Détecte et encode les visages de l'image (PIL, RGB).
+
+    La détection est faite sur une copie réduite de l'image (voir detect_faces) et les encodages sont calculés à
+    meilleure résolution sur l'image elle-même.
+    Renvoie le tuple (face_locations, face_encodings).
+    """
+    face_locations = detect_faces(image)
+
+    with timer('encoding') as stage:
+        face_encodings = face_recognition.face_encodings(numpy.asarray(image), face_locations,
+                                                         num_jitters=settings.NUM_JITTERS,
+                                                         model=settings.FACE_RECOGNITION_MODEL)
+        stage.add(len(face_encodings))
+    return face_locations, face_encodings
+
+
+def encode_image_file(img_path):
+    """Renvoie le tuple (face_locations, face_encodings) des visages de l'image img_path."""
+    return detect_and_encode(load_image(img_path, settings.FACE_ENCODING_MAX_SIZE))
+
+
+def prefetch_images(imgs_paths, max_size, depth, max_bytes):
+    """
+    Génère les tuples (img_path, image, error) des images de imgs_paths, dans l'ordre.
+
+    Les images suivantes sont lues et décodées à l'avance par un pool de depth threads pendant que l'appelant traite
+    l'image courante (le décodage de Pillow libère le GIL). On ne lance pas de nouveau décodage tant que les images
+    décodées en attente occupent plus de max_bytes octets. Avec depth = 0, les images sont décodées une par une.
+    error contient l'exception levée si l'image n'a pas pu être décodée.
+    """
+    if depth <= 0:
+        for img_path in imgs_paths:
+            try:
+                yield img_path, load_image(img_path, max_size), None
+            except Exception as e:
+                yield img_path, None, e
+        return
+
+    # Taille estimée d'une image décodée, tant qu'on n'en a pas décodé une
+    estimated_bytes = max_size * max_size * 3
+
+    def image_bytes(future):
+        if future.done() and future.exception() is None:
+            image = future.result()
+            return image.width * image.height * 3
+        return estimated_bytes
+
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque()
+        remaining_paths = iter(imgs_paths)
+
+        def fill():
+            while len(pending) < depth + 1 and (len(pending) == 0 or
+                                                sum(image_bytes(future) for _, future in pending) <= max_bytes):
+                img_path = next(remaining_paths, None)
+                if img_path is None:
+                    return
+                pending.append((img_path, executor.submit(load_image, img_path, max_size)))
+
+        fill()
+        while pending:
+            img_path, future = pending.popleft()
+            image, error = None, None
+            try:
+                image = future.result()
+                estimated_bytes = image.width * image.height * 3
+            except Exception as e:
+                error = e
+
+            # On lance le décodage des images suivantes avant de rendre la main à l'appelant
+            fill()
+            yield img_path, image, error
@@ -1,9 +1,14 @@
+import os
+from io import BytesIO
+
 from django import forms
 from django.conf import settings
+from django.core.files.base import ContentFile
 from django.db.models import Q
 from django.db.models.functions import datetime
 from django.utils import timezone
 
+from .face_detection import detect_faces, load_demand_photo
 from .models import Demand, Directory
 
 
@@ -22,6 +27,24 @@ class DemandForm(forms.ModelForm):
             'photo': 'Photo',
         }
 
+    def clean_photo(self):
+        # La photo est redressée, réduite et réenregistrée en JPEG avant d'être stockée : elle prend moins de place et
+        # son encodage est plus rapide
+        photo = self.cleaned_data['photo']
+        try:
+            image = load_demand_photo(photo, settings.DEMAND_PHOTO_MAX_SIZE)
+        except Exception:
+            raise forms.ValidationError("Impossible de lire la photo envoyée.")
+
+        # On refuse tout de suite les photos sans visage plutôt que de prévenir l'utilisateur par mail après l'encodage
+        if settings.WITH_FACE_RECOGNITION and settings.DEMAND_PHOTO_FACE_CHECK and len(detect_faces(image)) == 0:
+            raise forms.ValidationError("Aucun visage n'a été trouvé sur la photo. Merci d'envoyer une photo où ton "
+                                        "visage est bien visible.")
+
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=90)
+        return ContentFile(output.getvalue(), name=os.path.splitext(os.path.basename(photo.name))[0] + '.jpg')
+
     def clean(self):
         cleaned_data = super().clean()
         waiting_date = timezone.now() - timezone.timedelta(minutes=settings.MIN_TIME_BETWEEN_DEMANDS)
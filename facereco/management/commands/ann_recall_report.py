@@ -0,0 +1,103 @@
+import json
+import time
+
+import numpy
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from facereco.ann_index import build_ann_index, find_candidates
+from facereco.encodings import unpack_encodings
+from facereco.matching import load_directory_encodings
+from facereco.models import Demand, Directory
+
+
+class Command(BaseCommand):
+    help = "Compare la recherche approximative (IVF) à la recherche exhaustive sur un répertoire pour choisir ANN_NPROBE"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory_id', type=int)
+        parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+        parser.add_argument('--nlist', type=int, default=settings.ANN_NLIST)
+        parser.add_argument('--queries', type=int, default=200,
+                            help="Nombre de visages recherchés (demandes du répertoire, complétées par des visages "
+                                 "du répertoire tirés au hasard)")
+        parser.add_argument('--json', action='store_true')
+
+    def handle(self, *args, **options):
+        if not Directory.objects.filter(pk=options['directory_id']).exists():
+            raise CommandError("Directory not found")
+
+        faces_encodings, _, _ = load_directory_encodings(options['directory_id'])
+        faces_encodings = numpy.asarray(faces_encodings, dtype=numpy.float64)
+        if len(faces_encodings) == 0:
+            raise CommandError("No face indexed in this directory")
+
+        # Visages recherchés : ceux des demandes du répertoire, puis des visages du répertoire (en excluant de leurs
+        # résultats le visage lui-même)
+        queries = []
+        queries_faces = []
+        demands = Demand.objects.filter(directory__pk=options['directory_id'], face_encoding_data__isnull=False)
+        for face_encoding_data in demands.values_list('face_encoding_data', flat=True)[:options['queries']]:
+            queries.append(unpack_encodings(face_encoding_data)[0].astype(numpy.float64))
+            queries_faces.append(-1)
+        rng = numpy.random.default_rng(0)
+        sampled_faces = rng.choice(len(faces_encodings), min(len(faces_encodings), options['queries'] - len(queries)),
+                                   replace=False)
+        for face_index in sampled_faces:
+            queries.append(faces_encodings[face_index])
+            queries_faces.append(face_index)
+
+        tolerance = settings.FACE_MATCHING_THRESHOLD
+
+        start = time.perf_counter()
+        exact_matches = []
+        for query, query_face in zip(queries, queries_faces):
+            distances = numpy.linalg.norm(faces_encodings - query, axis=1)
+            exact_matches.append(set(numpy.nonzero(distances <= tolerance)[0].tolist()) - {query_face})
+        exhaustive_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        ann_index = build_ann_index(faces_encodings, options['nlist'], settings.ANN_KMEANS_ITERATIONS)
+        build_time = time.perf_counter() - start
+
+        report = {
+            "directory_id": options['directory_id'],
+            "faces": len(faces_encodings),
+            "nlist": len(ann_index[0]),
+            "queries": len(queries),
+            "tolerance": tolerance,
+            "build_seconds": build_time,
+            "exhaustive_ms_per_query": exhaustive_time * 1000,
+            "results": [],
+        }
+
+        for nprobe in options['nprobe']:
+            found = 0
+            expected = 0
+            compared = 0
+            start = time.perf_counter()
+            for query, query_face, exact in zip(queries, queries_faces, exact_matches):
+                candidates = find_candidates(query, ann_index, nprobe)
+                compared += len(candidates)
+                distances = numpy.linalg.norm(faces_encodings[candidates] - query, axis=1)
+                ann = set(candidates[distances <= tolerance].tolist()) - {query_face}
+                found += len(ann & exact)
+                expected += len(exact)
+            report["results"].append({
+                "nprobe": nprobe,
+                "recall": found / expected if expected > 0 else 1.0,
+                "compared_faces_ratio": compared / (len(queries) * len(faces_encodings)),
+                "ms_per_query": (time.perf_counter() - start) / len(queries) * 1000,
+            })
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"{report['faces']} faces, {report['nlist']} cells, {report['queries']} queries, "
+                          f"index built in {build_time:.1f}s, exhaustive search "
+                          f"{report['exhaustive_ms_per_query']:.2f} ms/query")
+        self.stdout.write(f"{'nprobe':>8} {'recall':>8} {'compared':>10} {'ms/query':>10}")
+        for result in report["results"]:
+            self.stdout.write(f"{result['nprobe']:>8} {result['recall']:>8.4f} "
+                              f"{result['compared_faces_ratio']:>10.2%} {result['ms_per_query']:>10.2f}")
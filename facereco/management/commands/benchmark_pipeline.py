@@ -0,0 +1,245 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+from celery import current_app
+from celery.signals import task_postrun, task_prerun
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from PIL import Image
+
+from facereco.encoding_cache import cache_key, store_faces
+from facereco.encodings import ENCODING_SIZE
+from facereco.models import Demand, Directory, Photo
+from facereco.tasks import task_indexing_directory, task_search_photos
+
+# Écart type par composante des visages synthétiques : les encodages de face_recognition ont une norme proche de 1, deux
+# personnes différentes sont donc à une distance d'environ 1.4, bien au-delà du seuil de reconnaissance
+FACE_STD = ENCODING_SIZE ** -0.5
+# Écart type par composante entre deux photos d'une même personne (distance d'environ 0.2 au visage de référence)
+IDENTITY_NOISE_STD = 0.02
+
+
+class QueryCounter:
+    """Compte les requêtes exécutées sur la base (sans la limite de taille de connection.queries)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class TaskStats:
+    """Temps et nombre de requêtes par tâche Celery, mesurés avec les signaux task_prerun et task_postrun."""
+
+    def __init__(self, query_counter):
+        self.query_counter = query_counter
+        self.started = {}
+        self.stats = {}
+
+    def on_prerun(self, task_id=None, **kwargs):
+        self.started[task_id] = (time.perf_counter(), self.query_counter.count)
+
+    def on_postrun(self, task_id=None, task=None, **kwargs):
+        if task_id not in self.started:
+            return
+        start, queries = self.started.pop(task_id)
+        stats = self.stats.setdefault(task.name.rsplit('.', 1)[-1], {"calls": 0, "seconds": 0.0, "queries": 0})
+        stats["calls"] += 1
+        stats["seconds"] += time.perf_counter() - start
+        stats["queries"] += self.query_counter.count - queries
+
+    def __enter__(self):
+        task_prerun.connect(self.on_prerun, weak=False)
+        task_postrun.connect(self.on_postrun, weak=False)
+        return self
+
+    def __exit__(self, *args):
+        task_prerun.disconnect(self.on_prerun)
+        task_postrun.disconnect(self.on_postrun)
+
+
+def measure(function):
+    """Exécute function et renvoie son résultat avec la durée, les requêtes, le détail par tâche et le pic mémoire."""
+    query_counter = QueryCounter()
+    tracemalloc.start()
+    with connection.execute_wrapper(query_counter), TaskStats(query_counter) as task_stats:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        "seconds": seconds,
+        "queries": query_counter.count,
+        "peak_memory_bytes": peak_memory,
+        "tasks": task_stats.stats,
+    }
+
+
+class Command(BaseCommand):
+    help = "Mesure l'indexation et la recherche sur des répertoires synthétiques (visages aléatoires avec des " \
+           "personnes connues) et écrit les résultats en JSON. Les tâches sont exécutées directement dans une base " \
+           "de test."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, nargs='+', default=[1000, 10000],
+                            help="Tailles des répertoires générés")
+        parser.add_argument('--demands', type=int, nargs='+', default=[1, 10, 100],
+                            help="Nombres de demandes recherchées en même temps")
+        parser.add_argument('--faces-per-photo', type=int, default=3,
+                            help="Nombre maximal de visages par photo (tiré au hasard entre 0 et cette valeur)")
+        parser.add_argument('--appearances', type=int, default=5,
+                            help="Nombre de photos dans lesquelles apparaît chaque personne recherchée")
+        parser.add_argument('--search-modes', nargs='+', choices=['vectorized', 'sharded'],
+                            default=['vectorized', 'sharded'])
+        parser.add_argument('--image-size', type=int, default=32, help="Côté des images JPEG générées en pixels")
+        parser.add_argument('--detect', action='store_true',
+                            help="Détecte vraiment les visages des images générées au lieu de pré-remplir le cache "
+                                 "des encodages avec les visages synthétiques (nécessite face_recognition)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Fichier où écrire les résultats (sortie standard par défaut)")
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp(prefix='facereco_benchmark_')
+        old_config = setup_databases(verbosity=0, interactive=False)
+        old_eager = current_app.conf.task_always_eager, current_app.conf.task_eager_propagates
+        current_app.conf.task_always_eager = True
+        current_app.conf.task_eager_propagates = True
+        try:
+            with override_settings(WITH_FACE_RECOGNITION=True,
+                                   ENCODING_INDEX_PATH=os.path.join(work_dir, 'encoding_index'),
+                                   ARCHIVE_CACHE_PATH=os.path.join(work_dir, 'archive_cache'),
+                                   THUMBNAIL_PATH=os.path.join(work_dir, 'thumbnails'),
+                                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                report = self.run_benchmark(work_dir, options)
+        finally:
+            current_app.conf.task_always_eager, current_app.conf.task_eager_propagates = old_eager
+            teardown_databases(old_config, verbosity=0)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_benchmark(self, work_dir, options):
+        rng = numpy.random.default_rng(options['seed'])
+        identities = rng.normal(0, FACE_STD, (max(options['demands']), ENCODING_SIZE))
+
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": numpy.__version__,
+                "database": connection.vendor,
+                "detect": options['detect'],
+            },
+            "options": {key: options[key] for key in ('photos', 'demands', 'faces_per_photo', 'appearances',
+                                                      'search_modes', 'image_size', 'seed')},
+            "indexing": [],
+            "search": [],
+        }
+
+        for photos_count in options['photos']:
+            directory, expected_matches = self.generate_directory(work_dir, photos_count, identities, rng, options)
+
+            _, stats = measure(lambda: task_indexing_directory.delay(directory.id))
+            directory.refresh_from_db()
+            faces_count = sum(Photo.objects.filter(directory=directory).values_list('face_count', flat=True))
+            report["indexing"].append({
+                "photos": photos_count,
+                "faces": faces_count,
+                "processed_photos": directory.processed_photos,
+                "failed_photos": directory.failed_photos,
+                "photos_per_second": photos_count / stats["seconds"],
+                **stats,
+            })
+
+            photos_ids = dict(Photo.objects.filter(directory=directory).values_list('path', 'id'))
+            for search_mode in options['search_modes']:
+                for demands_count in options['demands']:
+                    report["search"].append(self.benchmark_search(directory, photos_ids, identities[:demands_count],
+                                                                  expected_matches, search_mode, faces_count, rng))
+
+        return report
+
+    def generate_directory(self, work_dir, photos_count, identities, rng, options):
+        """
+        Crée un répertoire de photos_count images JPEG et les visages synthétiques de chaque image : des visages
+        aléatoires et, pour chaque personne de identities, un visage proche du sien dans options['appearances'] photos.
+
+        Sauf avec --detect, les visages sont ajoutés au cache des encodages : l'indexation suit le chemin normal sans
+        détecter les visages. Renvoie le répertoire et, pour chaque personne, les chemins des photos où elle apparaît.
+        """
+        path = os.path.join(work_dir, f'directory_{photos_count}')
+        os.makedirs(path)
+
+        faces = [list(rng.normal(0, FACE_STD, (rng.integers(0, options['faces_per_photo'] + 1), ENCODING_SIZE)))
+                 for _ in range(photos_count)]
+        expected_matches = []
+        for identity in identities:
+            photos_indexes = rng.choice(photos_count, min(photos_count, options['appearances']), replace=False)
+            for photo_index in photos_indexes:
+                faces[photo_index].append(identity + rng.normal(0, IDENTITY_NOISE_STD, ENCODING_SIZE))
+            expected_matches.append({os.path.join(path, f'{photo_index}.jpg') for photo_index in photos_indexes})
+
+        cache_entries = []
+        size = options['image_size']
+        for photo_index, photo_faces in enumerate(faces):
+            img_path = os.path.join(path, f'{photo_index}.jpg')
+            pixels = rng.integers(0, 256, (size, size, 3), dtype=numpy.uint8)
+            Image.fromarray(pixels).save(img_path, 'JPEG')
+            if not options['detect']:
+                cache_entries.append((cache_key(img_path), [(0, size, size, 0)] * len(photo_faces), photo_faces))
+        store_faces(cache_entries)
+
+        directory = Directory.objects.create(name=f'Benchmark {photos_count}', path=path)
+        return directory, expected_matches
+
+    def benchmark_search(self, directory, photos_ids, demands_encodings, expected_matches, search_mode, faces_count,
+                         rng):
+        demands = []
+        for demand_index, identity in enumerate(demands_encodings):
+            demand = Demand(name='Benchmark', first_name=str(demand_index), email='benchmark@example.com',
+                            directory=directory, processing_status=Demand.WAITING_FOR_SEARCH)
+            demand.set_face_encoding(identity + rng.normal(0, IDENTITY_NOISE_STD, ENCODING_SIZE))
+            demands.append(demand)
+        Demand.objects.bulk_create(demands)
+        demands = list(Demand.objects.filter(directory=directory).order_by('id'))
+
+        with override_settings(VECTORIZED_SEARCH=search_mode == 'vectorized'):
+            _, stats = measure(lambda: task_search_photos.delay(directory.id, force=True))
+
+        # Rappel sur les personnes placées dans le répertoire, et photos trouvées en dehors de celles-ci
+        expected = 0
+        found = 0
+        unexpected = 0
+        for demand, expected_paths in zip(demands, expected_matches):
+            expected_ids = {photos_ids[path] for path in expected_paths}
+            demand_photos_ids = set(demand.photos.values_list('id', flat=True))
+            expected += len(expected_ids)
+            found += len(demand_photos_ids & expected_ids)
+            unexpected += len(demand_photos_ids - expected_ids)
+
+        Demand.objects.filter(directory=directory).delete()
+
+        return {
+            "photos": len(photos_ids),
+            "faces": faces_count,
+            "demands": len(demands),
+            "search_mode": search_mode,
+            "recall": found / expected if expected > 0 else 1.0,
+            "unexpected_matches": unexpected,
+            **stats,
+        }
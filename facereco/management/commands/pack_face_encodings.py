@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from facereco.models import Demand, Directory, Photo
+
+
+class Command(BaseCommand):
+    help = "Convertit les visages encodés stockés en JSON vers le stockage binaire (float32) et initialise les " \
+           "compteurs d'indexation des répertoires indexés avant leur ajout. À lancer une fois après la mise à jour."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        photos_count = 0
+        photos = Photo.objects.filter(face_encodings__isnull=False).only('id', 'face_encodings')
+        batch = []
+        for photo in photos.iterator(chunk_size=batch_size):
+            photo.set_face_encodings(photo.face_encodings)
+            batch.append(photo)
+            if len(batch) >= batch_size:
+                Photo.objects.bulk_update(batch, ['face_encodings_data', 'face_count', 'face_encodings'])
+                photos_count += len(batch)
+                batch = []
+        Photo.objects.bulk_update(batch, ['face_encodings_data', 'face_count', 'face_encodings'])
+        photos_count += len(batch)
+
+        demands_count = 0
+        demands = Demand.objects.filter(face_encoding__isnull=False).only('id', 'face_encoding')
+        batch = []
+        for demand in demands.iterator(chunk_size=batch_size):
+            demand.set_face_encoding(demand.face_encoding)
+            batch.append(demand)
+            if len(batch) >= batch_size:
+                Demand.objects.bulk_update(batch, ['face_encoding_data', 'face_encoding'])
+                demands_count += len(batch)
+                batch = []
+        Demand.objects.bulk_update(batch, ['face_encoding_data', 'face_encoding'])
+        demands_count += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"{photos_count} photos and {demands_count} demands converted"))
+
+        # Les répertoires indexés avant l'ajout de processed_photos et failed_photos ont des photos mais aucune photo
+        # traitée : ils seraient affichés en cours d'indexation pour toujours. Les photos en base sont celles qui ont été
+        # encodées, les autres fichiers comptés dans total_photos sont en échec.
+        directories_count = 0
+        directories = Directory.objects.filter(total_photos__gt=0, processed_photos=0, failed_photos=0,
+                                               indexing_pending_chunks__lte=0).annotate(photos_count=Count('photo'))
+        for directory in directories:
+            Directory.objects.filter(pk=directory.pk).update(
+                processed_photos=directory.photos_count,
+                failed_photos=max(directory.total_photos - directory.photos_count, 0))
+            directories_count += 1
+
+        self.stdout.write(self.style.SUCCESS(f"{directories_count} directories indexing counters initialized"))
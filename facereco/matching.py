@@ -0,0 +1,142 @@
+import numpy
+from django.conf import settings
+
+from .encoding_index import load_directory_index, read_directory_encodings
+from .encodings import ENCODING_SIZE, unpack_encodings
+from .models import Demand, Directory
+
+# Marge autour du seuil en dessous de laquelle on recalcule la distance exactement (le calcul par produit matriciel
+# introduit des erreurs d'arrondi qui pourraient faire basculer une comparaison à la limite du seuil)
+THRESHOLD_MARGIN = 1e-6
+
+# Nombre de liens demande-photo insérés par requête
+MATCHES_BATCH_SIZE = 1000
+
+
+def load_directory_encodings(dir_id):
+    """
+    Charge tous les visages encodés d'un répertoire dans une seule matrice contiguë.
+
+    On utilise l'index sur disque du répertoire s'il est à jour, sinon on lit les visages encodés en base.
+    Renvoie un tuple (encodings, faces_photo_ids, ann_index) où encodings est une matrice (nb_visages, 128),
+    faces_photo_ids le tableau qui donne, pour chaque ligne de la matrice, l'id de la photo dont provient le visage, et
+    ann_index l'index approximatif du répertoire (None s'il n'y en a pas).
+    """
+    directory = Directory.objects.get(pk=dir_id)
+
+    index = load_directory_index(directory)
+    if index is None:
+        encodings, photo_ids, offsets = read_directory_encodings(dir_id)
+        ann_index = None
+    else:
+        encodings, photo_ids, offsets, ann_index = index
+
+    faces_photo_ids = numpy.repeat(photo_ids, numpy.diff(offsets))
+
+    return encodings, faces_photo_ids, ann_index
+
+
+def find_matches(demands_encodings, faces_encodings, faces_photo_ids, tolerance, block_size):
+    """
+    Compare tous les visages recherchés à tous les visages d'un répertoire.
+
+    Le calcul de la matrice des distances demandes x visages se fait par blocs de block_size visages pour borner la
+    mémoire utilisée. Un visage correspond à une demande si leur distance euclidienne est inférieure ou égale à
+    tolerance, comme dans face_recognition.compare_faces.
+
+    Renvoie la liste des couples (indice de la demande, id de la photo) sans doublon.
+    """
+    demands_encodings = numpy.asarray(demands_encodings, dtype=numpy.float64).reshape(-1, ENCODING_SIZE)
+    faces_encodings = numpy.asarray(faces_encodings).reshape(-1, ENCODING_SIZE)
+
+    if len(demands_encodings) == 0 or len(faces_encodings) == 0:
+        return []
+
+    squared_tolerance = tolerance ** 2
+    demands_squared_norms = numpy.einsum('ij,ij->i', demands_encodings, demands_encodings)
+
+    matches = set()
+    for start in range(0, len(faces_encodings), block_size):
+        block = faces_encodings[start:start + block_size].astype(numpy.float64)
+        block_photo_ids = faces_photo_ids[start:start + block_size]
+
+        # ||a - b||² = ||a||² + ||b||² - 2 a.b, calculé pour tout le bloc en un seul produit matriciel
+        block_squared_norms = numpy.einsum('ij,ij->i', block, block)
+        squared_distances = demands_squared_norms[:, None] + block_squared_norms[None, :] - 2 * demands_encodings @ block.T
+
+        is_match = squared_distances <= squared_tolerance
+
+        # Pour les distances proches du seuil, on refait le calcul exact pour obtenir le même résultat que
+        # face_recognition.compare_faces
+        doubtful = numpy.abs(squared_distances - squared_tolerance) <= THRESHOLD_MARGIN
+        for demand_index, face_index in zip(*numpy.nonzero(doubtful)):
+            distance = numpy.linalg.norm(demands_encodings[demand_index] - block[face_index])
+            is_match[demand_index, face_index] = distance <= tolerance
+
+        for demand_index, face_index in zip(*numpy.nonzero(is_match)):
+            matches.add((int(demand_index), int(block_photo_ids[face_index])))
+
+    return sorted(matches)
+
+
+def save_matches(matches):
+    """
+    Ajoute les photos trouvées aux demandes.
+
+    matches est une liste de couples (id de la demande, id de la photo). Les demandes qui n'existent plus sont
+    ignorées, et les liens sont insérés directement dans la table d'association par lots de MATCHES_BATCH_SIZE, sans
+    erreur pour les liens qui existent déjà.
+    Renvoie la liste des couples qui n'étaient pas encore liés.
+    """
+    if len(matches) == 0:
+        return []
+
+    demands_ids = {demand_id for demand_id, _ in matches}
+    existing_demands_ids = set(Demand.objects.filter(pk__in=demands_ids).values_list('pk', flat=True))
+
+    DemandPhoto = Demand.photos.through
+    existing_links = set(DemandPhoto.objects.filter(demand_id__in=existing_demands_ids,
+                                                    photo_id__in={photo_id for _, photo_id in matches})
+                         .values_list('demand_id', 'photo_id'))
+    new_links = [(demand_id, photo_id) for demand_id, photo_id in matches
+                 if demand_id in existing_demands_ids and (demand_id, photo_id) not in existing_links]
+    DemandPhoto.objects.bulk_create([DemandPhoto(demand_id=demand_id, photo_id=photo_id)
+                                     for demand_id, photo_id in new_links],
+                                    batch_size=MATCHES_BATCH_SIZE, ignore_conflicts=True)
+
+    return new_links
+
+
+def match_new_photos(dir_id, photos):
+    """
+    Cherche les visages des demandes déjà lancées ou traitées du répertoire dans des photos qui viennent d'être
+    indexées, et ajoute les photos trouvées à ces demandes.
+
+    Les demandes en attente de recherche n'en ont pas besoin : la recherche sur tout le répertoire inclura ces photos.
+    Renvoie la liste des couples (id de la demande, id de la photo) trouvés et celle des couples qui n'étaient pas
+    encore liés (une photo modifiée peut déjà appartenir à la demande).
+    """
+    photos = [photo for photo in photos if photo.face_count > 0]
+    if len(photos) == 0:
+        return [], []
+
+    demands = Demand.objects.filter(directory__pk=dir_id, face_encoding_data__isnull=False,
+                                    processing_status__in=[Demand.PROCESSING, Demand.PROCESSED])
+    demands_ids = []
+    demands_encodings = []
+    for demand_id, face_encoding_data in demands.values_list('id', 'face_encoding_data'):
+        demands_ids.append(demand_id)
+        demands_encodings.append(unpack_encodings(face_encoding_data)[0])
+    if len(demands_ids) == 0:
+        return [], []
+
+    faces_encodings = numpy.concatenate([photo.get_face_encodings() for photo in photos])
+    faces_photo_ids = numpy.repeat(numpy.array([photo.id for photo in photos], dtype=numpy.int64),
+                                   [photo.face_count for photo in photos])
+
+    matches = find_matches(demands_encodings, faces_encodings, faces_photo_ids, settings.FACE_MATCHING_THRESHOLD,
+                           settings.FACE_SEARCHING_BLOCK_SIZE)
+    matches = [(demands_ids[demand_index], photo_id) for demand_index, photo_id in matches]
+    new_links = save_matches(matches)
+
+    return matches, new_links
@@ -0,0 +1,176 @@
+"""
+Mesure du temps passé dans chaque étape de l'indexation et de la recherche.
+
+Les tâches indiquent le répertoire qu'elles traitent (set_directory) et chronomètrent leurs étapes (timer). Les mesures
+sont cumulées en mémoire pendant la tâche puis ajoutées en base à la fin de celle-ci (StageMetric, une ligne par
+répertoire et par étape). Le temps d'attente des tâches dans la file du broker est mesuré par les signaux de Celery.
+
+Quand METRICS_ENABLED est désactivé, timer renvoie un objet qui ne fait rien et les signaux ne font rien.
+Les mesures sont gardées au niveau du processus : on suppose une tâche à la fois par processus (pool prefork).
+"""
+import threading
+import time
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+
+from .models import Directory, StageMetric
+
+# Mesures pas encore enregistrées : (id du répertoire, étape) -> [appels, secondes, unités traitées]
+_pending = {}
+# Les images sont décodées dans d'autres threads (prefetch_images)
+_pending_lock = threading.Lock()
+# Pile des tâches en cours (plusieurs quand les tâches sont exécutées directement, en mode eager) : pour chacune, le
+# répertoire traité et le temps passé dans la file
+_tasks = []
+
+
+def metrics_enabled():
+    return settings.METRICS_ENABLED
+
+
+class _Timer:
+    __slots__ = ('stage', 'items', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.items = 0
+
+    def add(self, items):
+        self.items += items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.perf_counter() - self.start, self.items)
+
+
+class _NullTimer:
+    def add(self, items):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(stage):
+    """
+    Chronomètre une étape : with timer('detection') as stage: ... stage.add(nombre de visages)
+    Les unités ajoutées avec add donnent le débit de l'étape (images/s, visages/s, comparaisons/s...).
+    """
+    if not settings.METRICS_ENABLED:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+def set_directory(dir_id):
+    """Indique le répertoire auquel sont attribuées les mesures de la tâche en cours."""
+    if settings.METRICS_ENABLED and len(_tasks) > 0:
+        _tasks[-1]['directory_id'] = dir_id
+
+
+def record(stage, seconds, items=0):
+    directory_id = _tasks[-1]['directory_id'] if len(_tasks) > 0 else None
+    if directory_id is None:
+        return
+    with _pending_lock:
+        metric = _pending.setdefault((directory_id, stage), [0, 0.0, 0])
+        metric[0] += 1
+        metric[1] += seconds
+        metric[2] += items
+
+
+def flush_metrics():
+    """Ajoute en base les mesures cumulées depuis le dernier enregistrement."""
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, {}
+
+    for (directory_id, stage), (calls, seconds, items) in pending.items():
+        increments = {'calls': F('calls') + calls, 'seconds': F('seconds') + seconds, 'items': F('items') + items}
+        if StageMetric.objects.filter(directory_id=directory_id, stage=stage).update(**increments) > 0:
+            continue
+        try:
+            StageMetric.objects.create(directory_id=directory_id, stage=stage, calls=calls, seconds=seconds,
+                                       items=items)
+        except IntegrityError:
+            # Ligne créée entre temps par une autre tâche, ou répertoire supprimé
+            StageMetric.objects.filter(directory_id=directory_id, stage=stage).update(**increments)
+
+
+@before_task_publish.connect
+def add_publication_date(headers=None, **kwargs):
+    if settings.METRICS_ENABLED and headers is not None:
+        headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def start_task_metrics(task=None, **kwargs):
+    if not settings.METRICS_ENABLED:
+        return
+
+    # Pas de date de publication quand la tâche est exécutée directement
+    published_at = getattr(task.request, 'published_at', None)
+    queue_wait = max(0.0, time.time() - published_at) if published_at is not None else None
+    _tasks.append({'directory_id': None, 'name': task.name.rsplit('.', 1)[-1], 'queue_wait': queue_wait})
+
+
+@task_postrun.connect
+def end_task_metrics(**kwargs):
+    if not settings.METRICS_ENABLED or len(_tasks) == 0:
+        return
+
+    if _tasks[-1]['queue_wait'] is not None:
+        record('queue_wait.' + _tasks[-1]['name'], _tasks[-1]['queue_wait'], 1)
+    _tasks.pop()
+    flush_metrics()
+
+
+def _format_metric(name, labels, value):
+    labels = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    return f"{name}{{{labels}}} {value}"
+
+
+def prometheus_metrics():
+    """Renvoie les mesures de chaque répertoire au format texte de Prometheus."""
+    lines = []
+
+    metrics = StageMetric.objects.order_by('directory_id', 'stage')\
+        .values_list('directory_id', 'stage', 'calls', 'seconds', 'items')
+    series = [
+        ("facereco_stage_calls_total", "counter", "Number of timed executions of the stage", 2),
+        ("facereco_stage_seconds_total", "counter", "Time spent in the stage", 3),
+        ("facereco_stage_items_total", "counter", "Items processed by the stage (images, faces, comparisons...)", 4),
+    ]
+    for name, metric_type, help_text, column in series:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for metric in metrics:
+            lines.append(_format_metric(name, {'directory': metric[0], 'stage': metric[1]}, metric[column]))
+
+    lines.append("# HELP facereco_stage_items_per_second Average throughput of the stage")
+    lines.append("# TYPE facereco_stage_items_per_second gauge")
+    for directory_id, stage, calls, seconds, items in metrics:
+        if seconds > 0:
+            lines.append(_format_metric("facereco_stage_items_per_second",
+                                        {'directory': directory_id, 'stage': stage}, items / seconds))
+
+    lines.append("# HELP facereco_directory_photos Photos of the directory by indexing state")
+    lines.append("# TYPE facereco_directory_photos gauge")
+    for directory_id, total, processed, failed in Directory.objects.order_by('id')\
+            .values_list('id', 'total_photos', 'processed_photos', 'failed_photos'):
+        for state, value in (("total", total), ("processed", processed), ("failed", failed)):
+            lines.append(_format_metric("facereco_directory_photos", {'directory': directory_id, 'state': state},
+                                        value))
+
+    return "\n".join(lines) + "\n"
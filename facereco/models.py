@@ -1,14 +1,15 @@
 import os.path
 import uuid
 
-from celery.result import GroupResult
 from django.db import models
 
 
 #Modele qui contient les demandes de reconnaissance faciale
 from django.db.models import CASCADE
+from django.utils import timezone
 
 from TTSG.settings import BASE_PATH_FOR_DIRECTORIES
+from .encodings import pack_encodings, unpack_encodings
 
 
 class Demand(models.Model):
@@ -36,8 +37,13 @@ class Demand(models.Model):
     directory = models.ForeignKey('directory', on_delete=CASCADE)
     photos = models.ManyToManyField('photo', blank=True)
     request_token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
-    face_encoding = models.JSONField(blank=True, null=True)
+    face_encoding_data = models.BinaryField(blank=True, null=True)
+    # Ancien stockage JSON du visage encodé, conservé le temps de convertir les anciennes demandes
+    # (commande pack_face_encodings)
+    face_encoding = models.JSONField(blank=True, null=True, editable=False)
     search_task_id = models.CharField(max_length=200, blank=True, null=True, default=None)
+    # Nombre de photos trouvées après le traitement de la demande, pas encore annoncées par mail
+    new_photos_count = models.IntegerField(default=0)
 
     def delete(self, using=None, keep_parents=False):
 
@@ -48,6 +54,17 @@ class Demand(models.Model):
     def is_processed(self):
         return self.processing_status == "PROCESSED"
 
+    def get_face_encoding(self):
+        if self.face_encoding_data is None:
+            if self.face_encoding is None:
+                return None
+            return unpack_encodings(pack_encodings(self.face_encoding))[0]
+        return unpack_encodings(self.face_encoding_data)[0]
+
+    def set_face_encoding(self, face_encoding):
+        self.face_encoding_data = pack_encodings(face_encoding)
+        self.face_encoding = None
+
 
 
 class Directory(models.Model):
@@ -58,26 +75,37 @@ class Directory(models.Model):
     total_photos = models.IntegerField(default=0)
     #date d'indexation
     last_indexing_date = models.DateTimeField(default=None, blank=True, null=True)
+    # Tâches d'encodage de l'indexation en cours pas encore terminées, et date de la dernière tâche lancée ou terminée :
+    # une indexation sans nouvelle depuis STALLED_TASKS_TIMEOUT minutes est terminée par task_release_stalled_tasks
+    indexing_pending_chunks = models.IntegerField(default=0)
+    indexing_last_progress = models.DateTimeField(default=None, blank=True, null=True)
+    # Date de lancement de la dernière recherche (voir task_search_photos)
+    last_search_date = models.DateTimeField(default=None, blank=True, null=True)
+
+    # Compteurs d'avancement de l'indexation, mis à jour de manière atomique par les tâches d'encodage (initialisés par
+    # la commande pack_face_encodings pour les répertoires indexés avant leur ajout)
+    processed_photos = models.IntegerField(default=0)
+    failed_photos = models.IntegerField(default=0)
 
     @property
     def indexed_photos(self):
-        return len(Photo.objects.filter(directory=self))
+        return self.processed_photos
 
     @property
     def indexing_status(self):
-        if self.total_photos == 0:
+        if self.indexing_pending_chunks > 0:
+            # Parcours du répertoire ou encodage en cours
+            return "INDEXING"
+        elif self.total_photos == 0:
             return "NOT_INDEXED"
-        elif self.total_photos == self.indexed_photos:
-            return "INDEXED"
-        else:
-            res = GroupResult.restore(self.indexing_task_id)
-            if res is not None:
-                for child in res.children:
-                    if child.status == "FAILURE" or child.status == "RETRY":
-                        return "ERROR"
-
-                return "INDEXING"
+        elif self.processed_photos + self.failed_photos < self.total_photos:
+            return "INDEXING"
+        elif self.processed_photos == 0:
+            # Aucune photo n'a pu être encodée
             return "ERROR"
+        else:
+            # Les photos en échec sont des fichiers qui n'ont pas pu être lus, elles sont comptées dans failed_photos
+            return "INDEXED"
 
     def __str__(self):
         return self.name
@@ -86,7 +114,24 @@ class Directory(models.Model):
 class Photo(models.Model):
     directory = models.ForeignKey('directory', on_delete=CASCADE)
     path = models.CharField(max_length=200)
-    face_encodings = models.JSONField()
+    # Taille et date de modification du fichier lors de son indexation, pour ne réencoder que les fichiers modifiés
+    file_size = models.BigIntegerField(blank=True, null=True)
+    file_mtime = models.FloatField(blank=True, null=True)
+    face_count = models.PositiveIntegerField(default=0)
+    face_encodings_data = models.BinaryField(default=b'')
+    # Ancien stockage JSON des visages encodés, conservé le temps de convertir les anciennes photos
+    # (commande pack_face_encodings)
+    face_encodings = models.JSONField(blank=True, null=True, editable=False)
+
+    def get_face_encodings(self):
+        if self.face_count == 0 and self.face_encodings is not None:
+            return unpack_encodings(pack_encodings(self.face_encodings))
+        return unpack_encodings(self.face_encodings_data)
+
+    def set_face_encodings(self, face_encodings):
+        self.face_encodings_data = pack_encodings(face_encodings)
+        self.face_count = len(face_encodings)
+        self.face_encodings = None
 
     def __str__(self):
         if self.path is not None and self.path != "" and self.directory is not None:
@@ -94,3 +139,59 @@ class Photo(models.Model):
         else:
             return "Photo id="+str(self.pk)
 
+    class Meta:
+        # Les tâches d'encodage cherchent les photos déjà indexées par répertoire et chemin : la contrainte sert aussi
+        # d'index, et empêche deux indexations d'un même répertoire de créer deux lignes pour un même fichier
+        constraints = [models.UniqueConstraint(fields=['directory', 'path'], name='unique_directory_photo_path')]
+
+
+
+# Lot de recherche : les demandes recherchées ensemble dans un répertoire et leurs visages encodés, enregistrés une
+# seule fois pour que les tâches de recherche ne reçoivent que l'id du lot
+class SearchBatch(models.Model):
+    directory = models.ForeignKey('directory', on_delete=CASCADE)
+    date = models.DateTimeField(auto_now_add=True)
+    demands_ids = models.JSONField(default=list)
+    demands_encodings_data = models.BinaryField(default=b'')
+    # Tâches de recherche du lot pas encore terminées, et tâches en échec (voir sharding.finish_shard)
+    pending_shards = models.IntegerField(default=0)
+    failed_shards = models.IntegerField(default=0)
+    # Date du lancement des tâches de recherche ou de la dernière tâche terminée (voir task_release_stalled_tasks)
+    last_progress = models.DateTimeField(default=timezone.now)
+
+    def get_demands_encodings(self):
+        return unpack_encodings(self.demands_encodings_data)
+
+    def set_demands(self, demands_ids, demands_encodings):
+        self.demands_ids = list(demands_ids)
+        self.demands_encodings_data = pack_encodings(demands_encodings)
+
+
+# Débit mesuré des tâches de recherche et d'indexation (unités de travail par seconde), utilisé pour découper le
+# travail en tâches de durée homogène
+class ShardThroughput(models.Model):
+    kind = models.CharField(max_length=50, unique=True)
+    units_per_second = models.FloatField()
+
+
+# Cache des visages détectés et encodés, indexé par l'empreinte du contenu du fichier et des paramètres d'encodage.
+# Une même image présente dans plusieurs répertoires (ou envoyée plusieurs fois) n'est encodée qu'une fois.
+class EncodingCache(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    face_count = models.PositiveIntegerField(default=0)
+    face_locations = models.JSONField(default=list)
+    face_encodings_data = models.BinaryField(default=b'')
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+# Temps passé et quantité de travail traitée dans chaque étape de l'indexation et de la recherche, cumulés par
+# répertoire (voir metrics.py)
+class StageMetric(models.Model):
+    directory = models.ForeignKey('directory', on_delete=CASCADE)
+    stage = models.CharField(max_length=100)
+    calls = models.BigIntegerField(default=0)
+    seconds = models.FloatField(default=0)
+    items = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['directory', 'stage'], name='unique_directory_stage')]
@@ -0,0 +1,58 @@
+import os
+
+# Extensions des images indexées, les autres fichiers (vidéos, RAW, fichiers cachés...) sont ignorés
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+
+# Premiers octets des formats d'image indexés
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM', b'II*\x00', b'MM\x00*')
+
+
+def is_image_file(path):
+    """Vérifie d'après ses premiers octets que le fichier est bien une image."""
+    try:
+        with open(path, 'rb') as image_file:
+            header = image_file.read(12)
+    except OSError:
+        return False
+    return header.startswith(IMAGE_SIGNATURES) or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+
+
+def iter_image_files(path, errors=None):
+    """
+    Parcourt l'arborescence de path et génère au fur et à mesure les tuples (chemin, taille, date de modification) des
+    images trouvées.
+
+    os.scandir donne le type des fichiers sans appel système supplémentaire. Les fichiers et dossiers cachés sont
+    ignorés, ainsi que les fichiers dont l'extension n'est pas celle d'une image. Les premiers octets ne sont pas
+    vérifiés ici (is_image_file) : seuls ceux des fichiers nouveaux ou modifiés ont besoin de l'être.
+    Les dossiers et fichiers illisibles sont ajoutés à la liste errors (tuples (chemin, exception)) : le parcours est
+    alors incomplet.
+    """
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            if errors is not None:
+                errors.append((directory, e))
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    file_stat = entry.stat()
+                except OSError as e:
+                    if errors is not None:
+                        errors.append((entry.path, e))
+                    continue
+                yield entry.path, file_stat.st_size, file_stat.st_mtime
@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import ShardThroughput
+
+# Poids de la dernière mesure dans la moyenne glissante du débit
+THROUGHPUT_SMOOTHING = 0.2
+
+SEARCH = "search"
+INDEXING = "indexing"
+
+
+def target_shard_units(kind, default_units):
+    """
+    Renvoie la quantité de travail d'une tâche pour qu'elle dure environ TARGET_SHARD_DURATION secondes, d'après le
+    débit mesuré sur les tâches précédentes. Sans mesure, on utilise default_units.
+    """
+    if not settings.ADAPTIVE_SHARDING:
+        return default_units
+
+    units_per_second = ShardThroughput.objects.filter(kind=kind).values_list('units_per_second', flat=True).first()
+    if not units_per_second:
+        return default_units
+    return units_per_second * settings.TARGET_SHARD_DURATION
+
+
+def record_shard(kind, units, duration):
+    """Met à jour la moyenne glissante du débit avec la durée d'une tâche qui a traité units unités de travail."""
+    if not settings.ADAPTIVE_SHARDING or units == 0 or duration <= 0:
+        return
+
+    units_per_second = units / duration
+    updated = ShardThroughput.objects.filter(kind=kind).update(
+        units_per_second=F('units_per_second') * (1 - THROUGHPUT_SMOOTHING) + units_per_second * THROUGHPUT_SMOOTHING)
+    if updated == 0:
+        ShardThroughput.objects.get_or_create(kind=kind, defaults={'units_per_second': units_per_second})
+
+
+def finish_shard(model, pk, counter, **increments):
+    """
+    Décrémente le compteur de tâches restantes counter de la ligne pk de model (en appliquant aussi les mises à jour
+    increments) et renvoie True si la tâche était la dernière : une seule tâche d'un lot peut recevoir True, elle lance
+    la suite du traitement.
+    """
+    with transaction.atomic():
+        # La mise à jour verrouille la ligne jusqu'à la fin de la transaction : la valeur lue ensuite est celle laissée
+        # par cette tâche
+        if model.objects.filter(pk=pk).update(**{counter: F(counter) - 1}, **increments) == 0:
+            return False
+        remaining = model.objects.filter(pk=pk).values_list(counter, flat=True).get()
+    return remaining == 0
+
+
+def split_into_shards(items, target_units):
+    """
+    Découpe items, une suite de tuples (élément, unités de travail), en listes d'éléments d'environ target_units
+    unités chacune (au moins un élément par liste).
+    """
+    shard = []
+    shard_units = 0
+    for item, units in items:
+        shard.append(item)
+        shard_units += units
+        if shard_units >= target_units:
+            yield shard
+            shard = []
+            shard_units = 0
+    if len(shard) > 0:
+        yield shard
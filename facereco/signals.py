@@ -0,0 +1,23 @@
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from .archives import invalidate_archives
+from .models import Demand
+
+
+# Les archives en cache d'une demande ne sont plus valides dès que ses photos changent
+@receiver(m2m_changed, sender=Demand.photos.through)
+def invalidate_demand_archives(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        invalidate_archives(instance.pk)
+    elif pk_set is not None:
+        for demand_id in pk_set:
+            invalidate_archives(demand_id)
+
+
+@receiver(post_delete, sender=Demand)
+def delete_demand_archives(sender, instance, **kwargs):
+    invalidate_archives(instance.pk)
@@ -7,18 +7,34 @@ import numpy as np
 
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives, get_connection
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Avg, Count, F, Q
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import strip_tags
 
-if settings.WITH_FACE_RECOGNITION:
-    import face_recognition
+from celery import shared_task, group
+from celery.utils.log import get_task_logger
 
-from celery import shared_task, chord
+from .ann_index import find_matches_ann
+from .archives import archive_cache_enabled, build_archive, get_cached_archive, invalidate_archives
+from .encoding_index import build_directory_index, read_directory_encodings
+from .encodings import unpack_encodings
+from .encoding_cache import (cache_key, encode_image_file_cached, encoding_cache_enabled, evict_encoding_cache,
+                             get_cached_faces, store_faces)
+from .face_detection import detect_and_encode, prefetch_images
+from .metrics import set_directory, timer
+from .matching import load_directory_encodings, find_matches, save_matches, match_new_photos
+from .models import Directory, Photo, Demand, SearchBatch
+from .scanner import is_image_file, iter_image_files
+from .thumbnails import save_thumbnail, thumbnails_enabled
+from .sharding import INDEXING, SEARCH, finish_shard, record_shard, split_into_shards, target_shard_units
 
-from .models import Directory, Photo, Demand
+logger = get_task_logger(__name__)
+
+# Taille supposée d'une image, tant qu'aucune photo du répertoire n'a été indexée
+DEFAULT_IMAGE_SIZE = 5 * 1024 * 1024
 
 
 @shared_task()
@@ -42,6 +58,7 @@ def encode_demand_photo(demand_id):
     if len(queryset) != 1:
         raise Exception("Demand not found", {"demand_id": demand_id})
     demand = queryset[0]
+    set_directory(demand.directory_id)
 
     demand.processing_status = Demand.FACE_ENCODING
     demand.save()
@@ -50,10 +67,9 @@ def encode_demand_photo(demand_id):
         raise Exception("No photo found", {"demand_id": demand_id})
 
     if settings.WITH_FACE_RECOGNITION:
-        photo = face_recognition.api.load_image_file(demand.photo.path)
-        face_locations = face_recognition.face_locations(photo)
-        face_encodings = face_recognition.face_encodings(photo, face_locations, num_jitters=settings.NUM_JITTERS,
-                                                         model=settings.FACE_RECOGNITION_MODEL)
+        with timer('demand_encoding') as stage:
+            face_locations, face_encodings = encode_image_file_cached(demand.photo.path)
+            stage.add(1)
         if len(face_encodings) == 0:
             demand.processing_status = Demand.NO_FACE_FOUND
             demand.save()
@@ -61,7 +77,7 @@ def encode_demand_photo(demand_id):
             return {"demand_id": demand_id, "error": "No face found in photo"}
 
         face_encoding = face_encodings[0]  # On ne prend que le premier visage trouvé
-        demand.face_encoding = face_encoding.tolist() # On convertit le tableau numpy en liste python pour pouvoir le serialiser
+        demand.set_face_encoding(face_encoding)  # Le visage est stocké en binaire (float32)
         demand.processing_status = Demand.WAITING_FOR_SEARCH
         demand.save()
 
@@ -69,22 +85,67 @@ def encode_demand_photo(demand_id):
 
 
 
-    # On vérifie si on a atteint le nombre de demandes en attente de recherche dans le répertoire pour lancer la recherche
+    # On vérifie si on a atteint le nombre de demandes en attente de recherche dans le répertoire pour lancer la
+    # recherche (task_search_photos vérifie à nouveau en réservant les demandes)
     demands_waiting_for_search = Demand.objects.filter(Q(processing_status=Demand.WAITING_FOR_SEARCH)
-                                                       & Q(face_encoding__isnull=False)
+                                                       & Q(face_encoding_data__isnull=False)
                                                        & Q(directory__pk=demand.directory.pk))
 
-    if len(demands_waiting_for_search) > settings.FACE_SEARCHING_BATCH_SIZE:
+    if demands_waiting_for_search.count() >= settings.FACE_SEARCHING_BATCH_SIZE:
         task_search_photos.delay(demand.directory.pk)
 
 
+# Cette tâche est appelée toutes les heures pour borner la taille du cache des visages encodés
+@shared_task()
+def task_evict_encoding_cache():
+    if not encoding_cache_enabled():
+        return "Encoding cache disabled"
+
+    return f"{evict_encoding_cache()} cache entries deleted"
+
+
+# Cette tâche est appelée toutes les 15 minutes pour terminer les recherches et les indexations dont une tâche a disparu
+# sans se terminer (worker tué par manque de mémoire, message perdu par le broker) : le compteur de tâches restantes ne
+# reviendrait jamais à zéro, les demandes resteraient en PROCESSING et le répertoire en INDEXING
+@shared_task()
+def task_release_stalled_tasks():
+    deadline = timezone.now() - timezone.timedelta(minutes=settings.STALLED_TASKS_TIMEOUT)
+
+    # Chaque lot ou répertoire est libéré par une seule mise à jour conditionnelle : si sa dernière tâche se termine au
+    # même moment, un seul des deux voit le compteur passer à zéro et lance la fin du traitement
+    released_batches = 0
+    for search_batch_id in SearchBatch.objects.filter(pending_shards__gt=0, last_progress__lt=deadline)\
+            .values_list('id', flat=True):
+        if SearchBatch.objects.filter(pk=search_batch_id, pending_shards__gt=0, last_progress__lt=deadline)\
+                .update(pending_shards=0, failed_shards=F('failed_shards') + F('pending_shards')) == 0:
+            continue
+        logger.error("Search batch %s stalled, remaining search tasks counted as failed", search_batch_id)
+        demands_ids = SearchBatch.objects.filter(pk=search_batch_id).values_list('demands_ids', flat=True).first()
+        task_search_ending.delay(demands_ids, search_batch_id)
+        released_batches += 1
+
+    # Les photos des tâches d'encodage perdues sont comptées en échec
+    stalled_indexing = Q(indexing_pending_chunks__gt=0) & (Q(indexing_last_progress__lt=deadline)
+                                                           | Q(indexing_last_progress__isnull=True))
+    released_directories = 0
+    for dir_id in Directory.objects.filter(stalled_indexing).values_list('id', flat=True):
+        if Directory.objects.filter(stalled_indexing, pk=dir_id).update(
+                indexing_pending_chunks=0, failed_photos=F('total_photos') - F('processed_photos')) == 0:
+            continue
+        logger.error("Indexing of directory %s stalled, remaining photos counted as failed", dir_id)
+        task_indexing_ending.delay(dir_id)
+        released_directories += 1
+
+    return f"{released_batches} search batches and {released_directories} indexings released"
+
+
 # Cette tâche est appelée toutes les 5 minutes pour vérifier si il y a des demandes en attente de recherche
 @shared_task()
 def task_check_if_search_photos_needed():
     # On vérifie si il y a des demandes en attente de recherche plus vieilles que le temps d'attente autorisé
     max_date = timezone.now() - timezone.timedelta(minutes=settings.MAX_WAITING_TIME_BEFORE_SEARCH)
     demands_waiting_for_search = Demand.objects.filter(Q(processing_status=Demand.WAITING_FOR_SEARCH)
-                                                       & Q(face_encoding__isnull=False)
+                                                       & Q(face_encoding_data__isnull=False)
                                                        & Q(date__lte=max_date))
     dirs_ids = demands_waiting_for_search.values_list('directory__pk', flat=True).distinct()
     for dir_id in dirs_ids:
@@ -92,189 +153,683 @@ def task_check_if_search_photos_needed():
 
 
 
+"""
+    Cette tâche lance la recherche des demandes en attente d'un répertoire, si elles sont assez nombreuses
+    (FACE_SEARCHING_BATCH_SIZE) ou si la plus ancienne attend depuis MAX_WAITING_TIME_BEFORE_SEARCH minutes.
+
+    Elle peut être appelée plusieurs fois en même temps pour un même répertoire (après chaque encodage, par la tâche
+    périodique, par un administrateur) : les demandes sont réservées dans une transaction qui verrouille le répertoire,
+    et passent en PROCESSING avant la fin de celle-ci. Une seule recherche est donc lancée pour chaque demande. Une
+    recherche n'est pas relancée moins de SEARCH_DEBOUNCE_TIME secondes après la précédente, pour laisser le temps aux
+    demandes suivantes d'arriver.
+    dir_id : id du répertoire
+    force : lance la recherche quelles que soient la taille du lot et la date de la dernière recherche
+"""
 @shared_task()
-def task_search_photos(dir_id):
-    demands_waiting_for_search = Demand.objects.filter(Q(processing_status=Demand.WAITING_FOR_SEARCH)
-                                                       & Q(face_encoding__isnull=False)
-                                                       & Q(directory__pk=dir_id))
+def task_search_photos(dir_id, force=False):
+    set_directory(dir_id)
+
+    with transaction.atomic():
+        # Le verrou sur le répertoire empêche deux tâches de réserver les mêmes demandes
+        directory = Directory.objects.select_for_update().filter(pk=dir_id).first()
+        if directory is None:
+            return "Directory not found : id = {}".format(dir_id)
+
+        demands_waiting_for_search = Demand.objects.select_for_update(skip_locked=True)\
+            .filter(processing_status=Demand.WAITING_FOR_SEARCH, face_encoding_data__isnull=False,
+                    directory__pk=dir_id).order_by('date')
+        demands = list(demands_waiting_for_search.values_list('id', 'date', 'face_encoding_data'))
+        if len(demands) == 0:
+            return "No demand to search"
+
+        now = timezone.now()
+        if not force:
+            batch_full = len(demands) >= settings.FACE_SEARCHING_BATCH_SIZE
+            waited_too_long = demands[0][1] <= now - timezone.timedelta(minutes=settings.MAX_WAITING_TIME_BEFORE_SEARCH)
+            if not batch_full and not waited_too_long:
+                return "Not enough demands to search"
+            if directory.last_search_date is not None and not waited_too_long and \
+                    directory.last_search_date > now - timezone.timedelta(seconds=settings.SEARCH_DEBOUNCE_TIME):
+                # La recherche est relancée à la fin du délai, sans attendre la prochaine vérification périodique
+                countdown = (directory.last_search_date - now).total_seconds() + settings.SEARCH_DEBOUNCE_TIME
+                transaction.on_commit(lambda: task_search_photos.apply_async(args=[dir_id], countdown=countdown))
+                return "Search postponed"
+
+        demands_ids = [demand_id for demand_id, _, _ in demands]
+        demands_face_encodings_list = [unpack_encodings(face_encoding_data)[0] for _, _, face_encoding_data in demands]
+
+        Demand.objects.filter(pk__in=demands_ids).update(processing_status=Demand.PROCESSING)
+        Directory.objects.filter(pk=dir_id).update(last_search_date=now)
+
+        # Les demandes et leurs visages encodés sont enregistrés une seule fois dans un lot de recherche : les tâches
+        # de recherche ne reçoivent que l'id du lot
+        search_batch = SearchBatch(directory_id=dir_id)
+        search_batch.set_demands(demands_ids, demands_face_encodings_list)
+        search_batch.save()
+
+        # Les tâches de recherche ne sont envoyées qu'une fois les demandes réservées
+        transaction.on_commit(lambda: start_search(dir_id, search_batch.id, demands_ids))
 
-    if len(demands_waiting_for_search) == 0:
-        return "No demand to search"
+    return f"Search photos in directory n° {dir_id} started."
 
-    demands_ids = []
-    demands_face_encodings_list = []
 
-    # On rempli la liste des visages encodés des demandes en attente de recherche
-    for demand_id, face_encoding in demands_waiting_for_search.values_list('id', 'face_encoding'):
-        demands_ids.append(demand_id)
-        demands_face_encodings_list.append(numpy.array(face_encoding))
+def start_search(dir_id, search_batch_id, demands_ids):
+    """Lance les tâches de recherche d'un lot de recherche."""
+    if settings.VECTORIZED_SEARCH:
+        # Toute la recherche est faite dans une seule tâche qui compare d'un coup tous les visages du répertoire
+        SearchBatch.objects.filter(pk=search_batch_id).update(pending_shards=1, last_progress=timezone.now())
+        task_find_faces_in_directory.delay(search_batch_id)
+        return
+
+    # On découpe les photos encodées en intervalles d'ids, en ne lisant que les ids et le nombre de visages. Le travail
+    # d'une tâche est le nombre de comparaisons (visages x demandes) : une photo de foule compte plus qu'un paysage.
+    # Par défaut, une tâche traite l'équivalent de FACE_SEARCHING_CHUNK_SIZE photos d'un visage.
+    photos = Photo.objects.filter(directory__pk=dir_id, face_count__gt=0).order_by('id')\
+        .values_list('id', 'face_count')
+    target_units = target_shard_units(SEARCH, settings.FACE_SEARCHING_CHUNK_SIZE * len(demands_ids))
+    shards = split_into_shards(((photo_id, face_count * len(demands_ids)) for photo_id, face_count in photos.iterator()),
+                               target_units)
+    photos_ranges = [(shard[0], shard[-1]) for shard in shards]
+
+    if len(photos_ranges) == 0:
+        task_search_ending.delay(demands_ids, search_batch_id)
+        return
+
+    # On lance la recherche des visages dans les photos encodées en parallèle, une tâche par intervalle. Chaque tâche
+    # décrémente le compteur du lot en se terminant, la dernière lance la tâche de fin de recherche.
+    SearchBatch.objects.filter(pk=search_batch_id).update(pending_shards=len(photos_ranges),
+                                                          last_progress=timezone.now())
+    group(task_find_faces.s(search_batch_id, first_photo_id, last_photo_id)
+          for first_photo_id, last_photo_id in photos_ranges).apply_async()
+
+
+def finish_search_shard(search_batch_id, failed=False):
+    """Enregistre la fin d'une tâche de recherche du lot et lance la fin de la recherche après la dernière."""
+    increments = {'failed_shards': F('failed_shards') + 1} if failed else {}
+    if finish_shard(SearchBatch, search_batch_id, 'pending_shards', last_progress=timezone.now(), **increments):
+        demands_ids = SearchBatch.objects.filter(pk=search_batch_id).values_list('demands_ids', flat=True).first()
+        task_search_ending.delay(demands_ids, search_batch_id)
 
-    # On a désormais les visages encodés des demandes en attente de recherche dans la liste demands_face_encodings_list
 
-    # On récupère les photos encodées
-    photos = Photo.objects.filter(directory__pk=dir_id)
+"""
+    Cette fonction permet de trouver les visages des demandes d'un lot de recherche dans les photos dont l'id est
+    compris entre first_photo_id et last_photo_id.
 
-    parameters_list = [(demands_ids, demands_face_encodings_list, photo.id) for photo in photos]
-    # On lance la recherche des visages dans les photos encodées en parallèle avec des chunks de
-    # taille FACE_SEARCHING_CHUNK_SIZE
-    find_faces_tasks = [task_find_faces.chunks(parameters_list, settings.FACE_SEARCHING_CHUNK_SIZE).group()]
-    callback = task_search_ending.si(demands_ids)
-    chord(find_faces_tasks)(callback) # Une fois toutes les taches terminées, on lance la tache de fin de recherche
-    # (pour mettre un chunks dans un chord, astuce trouvé ici :
-    # https://stackoverflow.com/questions/65789241/celery-how-to-use-chunks-in-chord)
+    Elle est appelée par la fonction search_photos qui va lancer la recherche sur toutes les photos du répertoire.
+    search_batch_id : id du lot de recherche (demandes et visages encodés recherchés)
+    first_photo_id, last_photo_id : intervalle des ids des photos sur lesquelles on va effectuer la recherche
+"""
+@shared_task(bind=True, max_retries=3)
+def task_find_faces(self, search_batch_id, first_photo_id, last_photo_id):
+    start = time.monotonic()
+    try:
+        search_batch = SearchBatch.objects.get(pk=search_batch_id)
+    except SearchBatch.DoesNotExist:
+        return "Search batch not found : id = {}".format(search_batch_id)
+    set_directory(search_batch.directory_id)
 
-    demands_waiting_for_search.update(processing_status=Demand.PROCESSING)
+    try:
+        with timer('search_load') as stage:
+            faces_encodings, photo_ids, offsets = read_directory_encodings(search_batch.directory_id, first_photo_id,
+                                                                           last_photo_id)
+            faces_photo_ids = numpy.repeat(photo_ids, numpy.diff(offsets))
+            stage.add(len(faces_encodings))
+
+        demands_ids = search_batch.demands_ids
+        with timer('search_compare') as stage:
+            matches = find_matches(search_batch.get_demands_encodings(), faces_encodings, faces_photo_ids,
+                                   settings.FACE_MATCHING_THRESHOLD, settings.FACE_SEARCHING_BLOCK_SIZE)
+            stage.add(len(faces_encodings) * len(demands_ids))
+
+        # On ajoute les photos trouvées aux demandes (en une seule requête pour toutes les demandes trouvées)
+        with timer('search_save') as stage:
+            save_matches([(demands_ids[demand_index], photo_id) for demand_index, photo_id in matches])
+            stage.add(len(matches))
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            # Dernière tentative : la tâche est comptée en échec pour que la recherche du lot se termine
+            logger.error("Search failed in photos %s to %s of search batch %s : %s", first_photo_id, last_photo_id,
+                         search_batch_id, e)
+            finish_search_shard(search_batch_id, failed=True)
+            raise
+        raise self.retry(exc=e)
 
-    return f"Search photos in directory n° {dir_id} started."
+    record_shard(SEARCH, len(faces_encodings) * len(demands_ids), time.monotonic() - start)
+    finish_search_shard(search_batch_id)
 
+    return "ok"
 
 """
-    Cette fonction permet de trouver les visages présents dans la photo dont l'id est passé en paramètre.
+    Cette fonction cherche les visages des demandes dans toutes les photos du répertoire en une seule fois.
 
-    Elle est appelée par la fonction search_photos qui va lancer la recherche sur toutes les photos du répertoire.
-    demand_ids : liste des ids des demandes de reconnaissance faciale
-    demands_face_encodings_list : liste des visages encodés des demandes de reconnaissance faciale
-    photo_id : id de la photo sur laquelle on va effectuer la recherche
+    Tous les visages encodés du répertoire sont chargés dans une matrice, puis comparés par blocs aux visages des
+    demandes. Le résultat est le même qu'avec task_find_faces, sans lancer une tâche par intervalle de photos.
+    search_batch_id : id du lot de recherche (demandes, visages encodés recherchés et répertoire)
 """
+@shared_task(bind=True, max_retries=3)
+def task_find_faces_in_directory(self, search_batch_id):
+    try:
+        search_batch = SearchBatch.objects.get(pk=search_batch_id)
+    except SearchBatch.DoesNotExist:
+        return "Search batch not found : id = {}".format(search_batch_id)
+
+    set_directory(search_batch.directory_id)
+
+    try:
+        demands_ids = search_batch.demands_ids
+        demands_face_encodings_list = search_batch.get_demands_encodings()
+        with timer('search_load') as stage:
+            faces_encodings, faces_photo_ids, ann_index = load_directory_encodings(search_batch.directory_id)
+            stage.add(len(faces_encodings))
+
+        # Avec l'index approximatif, le nombre de comparaisons compté est celui d'une recherche exhaustive
+        with timer('search_compare') as stage:
+            if ann_index is not None and settings.ANN_NPROBE > 0:
+                # Très gros répertoire : on ne compare chaque visage recherché qu'aux visages des cellules les plus
+                # proches
+                matches = find_matches_ann(demands_face_encodings_list, faces_encodings, faces_photo_ids, ann_index,
+                                           settings.ANN_NPROBE, settings.FACE_MATCHING_THRESHOLD)
+            else:
+                matches = find_matches(demands_face_encodings_list, faces_encodings, faces_photo_ids,
+                                       settings.FACE_MATCHING_THRESHOLD, settings.FACE_SEARCHING_BLOCK_SIZE)
+            stage.add(len(faces_encodings) * len(demands_ids))
+
+        with timer('search_save') as stage:
+            save_matches([(demands_ids[demand_index], photo_id) for demand_index, photo_id in matches])
+            stage.add(len(matches))
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            logger.error("Search failed in search batch %s : %s", search_batch_id, e)
+            finish_search_shard(search_batch_id, failed=True)
+            raise
+        raise self.retry(exc=e)
+
+    finish_search_shard(search_batch_id)
+
+    return f"{len(matches)} matches found in {len(faces_encodings)} faces"
+
+
 @shared_task()
-def task_find_faces(demands_ids, demands_face_encodings_list, photo_id):
+def task_search_ending(demands_ids, search_batch_id=None):
+    # Le lot de recherche n'est plus utile
+    if search_batch_id is not None:
+        failed_shards = SearchBatch.objects.filter(pk=search_batch_id).values_list('failed_shards', flat=True).first()
+        if failed_shards:
+            logger.warning("Search batch %s ended with %s failed search tasks", search_batch_id, failed_shards)
+        SearchBatch.objects.filter(pk=search_batch_id).delete()
+
+    # Nombre de photos trouvées de chaque demande, en une seule requête (les demandes supprimées entre temps sont
+    # ignorées)
+    demands = list(Demand.objects.filter(pk__in=demands_ids).annotate(photos_found=Count('photos')).order_by('id')
+                   .values_list('id', 'directory_id', 'photos_found'))
+    if len(demands) == 0:
+        return "Search ended"
+    set_directory(demands[0][1])
+
+    processed_demands_ids = [demand_id for demand_id, _, _ in demands]
+    Demand.objects.filter(pk__in=processed_demands_ids).update(processing_status=Demand.PROCESSED)
+
+    # L'archive des photos trouvées est préparée en tâche de fond, avant que l'utilisateur ne clique sur le lien du mail
+    if archive_cache_enabled():
+        for demand_id, _, photos_found in demands:
+            if photos_found > 0:
+                task_build_demand_archive.delay(demand_id)
+
+    queue_notifications(task_send_search_notifications, processed_demands_ids)
+
+    return "Search ended"
+
+
+def queue_notifications(task, demands_ids):
+    """Envoie les mails des demandes par des tâches séparées, par paquets de NOTIFICATION_CHUNK_SIZE demandes."""
+    chunk_size = settings.NOTIFICATION_CHUNK_SIZE
+    for i in range(0, len(demands_ids), chunk_size):
+        task.delay(demands_ids[i:i + chunk_size])
+
+
+def send_notifications(task, demands_ids, demands, build_email, on_sent=None):
+    """
+    Envoie le mail de chaque demande de demands sur une seule connexion au serveur de mail. on_sent est appelé avec
+    chaque demande dont le mail a été envoyé.
+
+    En cas d'erreur, task est relancée avec les seules demandes de demands_ids dont le mail n'a pas été envoyé.
+    Renvoie le nombre de mails envoyés.
+    """
+    sent_demands_ids = set()
     try:
-        photo = Photo.objects.get(pk=photo_id)
-    except Photo.DoesNotExist:
-        return "Photo not found : id = {}".format(photo_id)
+        with timer('mail_send') as stage, get_connection() as connection:
+            for demand in demands:
+                set_directory(demand.directory_id)
+                connection.send_messages([build_email(demand)])
+                sent_demands_ids.add(demand.id)
+                if on_sent is not None:
+                    on_sent(demand)
+                stage.add(1)
+    except Exception as e:
+        remaining_demands_ids = [demand_id for demand_id in demands_ids if demand_id not in sent_demands_ids]
+        logger.warning("Sending notifications failed (%d remaining) : %s", len(remaining_demands_ids), e)
+        raise task.retry(args=[remaining_demands_ids], exc=e)
 
-    # On transforme les list python en tableaux numpy pour pouvoir les comparer avec les visages encodés.
-    photo_face_encodings_list = []
-    for encoding_list in photo.face_encodings:
-        photo_face_encodings_list.append(numpy.array(encoding_list))
+    return len(sent_demands_ids)
 
-    if settings.WITH_FACE_RECOGNITION:
 
-        # Pour chaque visage présent sur la photo, on appelle la fonction de comparaison qui va indiquer si le visage
-        # correspond à un visage recherché ou non.
-        # La fonction renvoie une liste de booléens, un booléen par visage recherché.
-
-        # On initialise la liste des booléens à False, a chaque visage, on fera une opération OU avec le résultat de la
-        # fonction match de manière a savoir si au moins un visage sur la photo correspond à un visage recherché.
-        matches = numpy.full(len(demands_face_encodings_list), False, dtype=bool)
-
-        for photo_face_encoding in photo_face_encodings_list:
-            matches |= numpy.array(
-                face_recognition.compare_faces(demands_face_encodings_list, photo_face_encoding,
-                                               tolerance=settings.FACE_MATCHING_THRESHOLD)
-                , dtype=bool)
-
-        # Une fois toutes les comparaisons effectuées, on parcourt la liste des booléens pour savoir si un visage
-        # correspondant à une demande a été trouvé.
-        # Si oui, on ajoute la photo à la demande.
-        for i in range(len(matches)):
-            if matches[i]:
-                try:
-                    demand = Demand.objects.get(pk=demands_ids[i])
-                    demand.photos.add(photo)
-                    demand.save()
-                except Demand.DoesNotExist:
-                    # Si la demande n'existe plus, on passe à la suivante
-                    continue
+def search_notification_email(demand):
+    """Renvoie le mail de fin de recherche de la demande (annotée avec photos_found)."""
+    if demand.photos_found == 0:
+        template = 'facereco/mails/mail_no_photo_found.html'
+        subject = demand.directory.name + " - Aucune photo trouvée"
+    else:
+        template = 'facereco/mails/mail_demand_processed.html'
+        subject = demand.directory.name + " - Vos photos sont disponibles !"
+
+    html_content = render_to_string(template, {'base_url': settings.BASE_URL, 'demand': demand})
+    txt_content = strip_tags(html_content)
+    email = EmailMultiAlternatives(subject, txt_content, settings.EMAIL_HOST_USER, [demand.email])
+    email.attach_alternative(html_content, "text/html")
+    return email
+
+
+"""
+    Cette tâche envoie les mails de fin de recherche d'un paquet de demandes, sur une seule connexion au serveur de
+    mail.
+
+    En cas d'erreur, la tâche est relancée avec les seules demandes dont le mail n'a pas été envoyé. Le nombre de
+    paquets envoyés par minute peut être limité par NOTIFICATION_RATE_LIMIT.
+    demands_ids : ids des demandes à prévenir
+"""
+@shared_task(bind=True, max_retries=5, rate_limit=settings.NOTIFICATION_RATE_LIMIT or None)
+def task_send_search_notifications(self, demands_ids):
+    demands = Demand.objects.filter(pk__in=demands_ids).select_related('directory')\
+        .annotate(photos_found=Count('photos')).order_by('id')
+
+    sent = send_notifications(self, demands_ids, demands, search_notification_email)
+
+    return f"{sent} search notifications sent"
 
-    return "ok"
 
 @shared_task()
-def task_search_ending(demands_ids):
-    emails_list = []
+def task_build_demand_archive(demand_id):
+    photos = list(Photo.objects.filter(demand__pk=demand_id).values_list('id', 'path'))
+    if len(photos) == 0:
+        return "No photo for demand : id = {}".format(demand_id)
+
+    photos_ids = [photo_id for photo_id, _ in photos]
+    if get_cached_archive(demand_id, photos_ids) is not None:
+        return "Archive already built"
+
+    path = build_archive(demand_id, photos_ids, [photo_path for _, photo_path in photos])
+
+    return f"Archive built : {path}"
 
-    for demand_id in demands_ids:
-        try:
-            demand = Demand.objects.get(pk=demand_id)
-            demand.processing_status = Demand.PROCESSED
-            demand.save()
 
-            if demand.photos.count() == 0:
-                html_content = render_to_string('facereco/mails/mail_no_photo_found.html',
-                                                {'base_url': settings.BASE_URL, 'demand': demand})
-                txt_content = strip_tags(html_content)
-                email = EmailMultiAlternatives(demand.directory.name + " - Aucune photo trouvée",
-                                               txt_content,
-                                               settings.EMAIL_HOST_USER, [demand.email])
-                email.attach_alternative(html_content, "text/html")
-                emails_list.append(email)
 
+def encode_image(img_path):
+    """Renvoie la liste des visages encodés trouvés dans l'image img_path."""
+    if settings.WITH_FACE_RECOGNITION:
+        # L'image est décodée à résolution réduite, les visages sont détectés sur une version encore plus petite
+        face_locations, face_encodings = encode_image_file_cached(img_path)
+        return face_encodings
+    else:
+        time.sleep(5)
+        return []
+
+
+def iter_encoded_images(imgs_paths):
+    """
+    Génère les tuples (img_path, face_encodings, error, decoded) des images de imgs_paths.
+
+    Les images déjà présentes dans le cache ne sont ni décodées ni encodées. Les autres sont décodées en parallèle
+    pendant la détection et l'encodage de l'image courante, puis ajoutées au cache. error contient l'exception levée si
+    l'image n'a pas pu être encodée, decoded indique si l'image a été décodée et encodée (et non lue dans le cache).
+    """
+    if not settings.WITH_FACE_RECOGNITION:
+        for img_path in imgs_paths:
+            yield img_path, encode_image(img_path), None, True
+        return
+
+    cache_keys = {}
+    cached_faces = {}
+    imgs_paths_to_decode = imgs_paths
+    if encoding_cache_enabled():
+        imgs_paths_to_decode = []
+        failed_paths = []
+        with timer('cache_lookup') as stage:
+            for img_path in imgs_paths:
+                try:
+                    cache_keys[img_path] = cache_key(img_path)
+                except Exception as e:
+                    failed_paths.append((img_path, e))
+            cached_faces = get_cached_faces(cache_keys.values())
+            stage.add(len(imgs_paths))
+
+        for img_path, e in failed_paths:
+            yield img_path, None, e, False
+
+        for img_path, key in cache_keys.items():
+            if key in cached_faces:
+                yield img_path, cached_faces[key][1], None, False
             else:
-                html_content = render_to_string('facereco/mails/mail_demand_processed.html',
-                                                {'base_url': settings.BASE_URL, 'demand': demand})
-                txt_content = strip_tags(html_content)
-                email = EmailMultiAlternatives(demand.directory.name+" - Vos photos sont disponibles !",
-                                               txt_content,
-                                               settings.EMAIL_HOST_USER, [demand.email])
-                email.attach_alternative(html_content, "text/html")
-                emails_list.append(email)
-
-        except Demand.DoesNotExist:
-            # Si la demande n'existe plus, on passe à la suivante
+                imgs_paths_to_decode.append(img_path)
+
+    new_cache_entries = []
+    for img_path, image, error in prefetch_images(imgs_paths_to_decode, settings.FACE_ENCODING_MAX_SIZE,
+                                                  settings.INDEXING_PREFETCH_DEPTH,
+                                                  settings.INDEXING_PREFETCH_MAX_MB * 1024 * 1024):
+        if error is not None:
+            yield img_path, None, error, False
             continue
 
-    # On envoie les mails
-    connection = get_connection()
-    connection.send_messages(emails_list)
+        # La miniature de la galerie est créée à partir de l'image déjà décodée pour l'encodage
+        if thumbnails_enabled():
+            try:
+                with timer('thumbnail') as stage:
+                    save_thumbnail(img_path, image)
+                    stage.add(1)
+            except Exception as e:
+                logger.warning("Thumbnail creation failed for %s : %s", img_path, e)
 
-    return "Search ended"
+        try:
+            face_locations, face_encodings = detect_and_encode(image)
+        except Exception as e:
+            yield img_path, None, e, False
+            continue
+
+        if img_path in cache_keys:
+            new_cache_entries.append((cache_keys[img_path], face_locations, face_encodings))
+        yield img_path, face_encodings, None, True
 
+    store_faces(new_cache_entries)
 
 
+"""
+    Cette tâche encode les visages d'une liste d'images d'un répertoire.
 
+    Une image qui ne peut pas être encodée est comptée comme un échec sans empêcher l'encodage des autres. Toutes les
+    photos du chunk sont ensuite enregistrées en une seule requête (plus une pour les photos déjà indexées).
+    dir_id : id du répertoire indexé
+    imgs_paths : chemins des images à encoder
+"""
 @shared_task(bind=True, max_retries=3)
-def task_face_encoding(self, dir_id, img_path):
+def task_face_encoding_chunk(self, dir_id, imgs_paths):
+    start = time.monotonic()
+    set_directory(dir_id)
     try:
-        if settings.WITH_FACE_RECOGNITION:
-            # On récupère l'image dont on veut encoder les visages
-            frame = face_recognition.api.load_image_file(img_path)
-
-            # On encode les visages
-            face_locations = face_recognition.face_locations(frame)
-            face_encodings = face_recognition.face_encodings(frame, face_locations, num_jitters=settings.NUM_JITTERS,
-                                                             model=settings.FACE_RECOGNITION_MODEL)
-
-            # On transforme les tableaux numpy en list python pour pouvoir les encoder en JSON.
-            face_encodings_list = []
-            for face_encoding in face_encodings:
-                face_encodings_list.append(face_encoding.tolist())
-        else:
-            time.sleep(5)
-            face_encodings_list = []
-        # On sauvegarde les visages encodés dans la base de données
-        photo = Photo.objects.create(directory_id=dir_id, path=img_path, face_encodings=face_encodings_list)
-
-        return "ok"
+        # Photos déjà indexées dont le fichier a été modifié : on met à jour leur ligne pour garder leurs liens avec
+        # les demandes
+        indexed_photos = {photo.path: photo
+                          for photo in Photo.objects.filter(directory_id=dir_id, path__in=imgs_paths)}
+
+        new_photos = []
+        updated_photos = []
+        failed = 0
+        faces = 0
+        encoded_bytes = 0
+        for img_path, face_encodings, error, decoded in iter_encoded_images(imgs_paths):
+            try:
+                if error is not None:
+                    raise error
+                file_stat = os.stat(img_path)
+            except Exception as e:
+                logger.warning("Face encoding failed for %s : %s", img_path, e)
+                failed += 1
+                continue
+
+            photo = indexed_photos.get(img_path)
+            if photo is None:
+                photo = Photo(directory_id=dir_id, path=img_path)
+                new_photos.append(photo)
+            else:
+                updated_photos.append(photo)
+            photo.set_face_encodings(face_encodings)
+            photo.file_size = file_stat.st_size
+            photo.file_mtime = file_stat.st_mtime
+            faces += photo.face_count
+            if decoded:
+                # Les images lues dans le cache ne comptent pas dans le débit de l'encodage
+                encoded_bytes += file_stat.st_size
+
+        # Une seule transaction : une nouvelle tentative ne retrouve pas une partie du chunk déjà enregistrée
+        with timer('db_write') as stage, transaction.atomic():
+            Photo.objects.bulk_create(new_photos)
+            if len(new_photos) > 0 and new_photos[0].pk is None:
+                # Certaines bases (MySQL) ne renvoient pas les ids des lignes insérées par bulk_create
+                photos_ids = dict(Photo.objects.filter(directory_id=dir_id,
+                                                       path__in=[photo.path for photo in new_photos])
+                                  .values_list('path', 'id'))
+                for photo in new_photos:
+                    photo.pk = photos_ids.get(photo.path)
+            Photo.objects.bulk_update(updated_photos, ['face_encodings_data', 'face_count', 'face_encodings',
+                                                       'file_size', 'file_mtime'])
+            stage.add(len(new_photos) + len(updated_photos))
     except Exception as e:
-        self.retry()
+        if self.request.retries >= self.max_retries:
+            # Dernière tentative : toutes les images du chunk sont comptées en échec pour que l'indexation se termine
+            finish_indexing_chunk(dir_id, failed_photos=F('failed_photos') + len(imgs_paths))
+            raise
+        raise self.retry(exc=e)
+
+    # Un chunk entièrement trouvé dans le cache ne donne pas de mesure du débit
+    record_shard(INDEXING, encoded_bytes, time.monotonic() - start)
+
+    processed = len(new_photos) + len(updated_photos)
+    finish_indexing_chunk(dir_id, processed_photos=F('processed_photos') + processed,
+                          failed_photos=F('failed_photos') + failed)
+
+    # Les photos ajoutées après le lancement ou la fin d'une recherche sont comparées tout de suite aux demandes
+    # concernées, sans relancer de recherche sur tout le répertoire
+    with timer('match_new_photos') as stage:
+        matches, new_links = match_new_photos(dir_id, new_photos + updated_photos)
+        stage.add(len(new_photos) + len(updated_photos))
+    if len(matches) > 0:
+        record_new_photos(matches, new_links)
+
+    return {"processed": processed, "failed": failed, "faces": faces, "matches": len(matches)}
+
+
+def finish_indexing_chunk(dir_id, **counters):
+    """Met à jour les compteurs du répertoire à la fin d'une tâche d'encodage et termine l'indexation après la dernière."""
+    if finish_shard(Directory, dir_id, 'indexing_pending_chunks', indexing_last_progress=timezone.now(), **counters):
+        task_indexing_ending.delay(dir_id)
+
+
+def record_new_photos(matches, new_links):
+    # Les archives des demandes dont les photos ont changé ne sont plus valides, y compris pour une photo modifiée qui
+    # appartenait déjà à la demande
+    demands_ids = {demand_id for demand_id, _ in matches}
+    for demand_id in demands_ids:
+        invalidate_archives(demand_id)
+
+    if not settings.NEW_PHOTOS_NOTIFICATION:
+        return
+
+    # On compte les photos ajoutées aux demandes déjà traitées, elles seront annoncées par task_notify_new_photos
+    new_photos_by_demand = {}
+    for demand_id, _ in new_links:
+        new_photos_by_demand[demand_id] = new_photos_by_demand.get(demand_id, 0) + 1
+    for demand_id, count in new_photos_by_demand.items():
+        Demand.objects.filter(pk=demand_id, processing_status=Demand.PROCESSED)\
+            .update(new_photos_count=F('new_photos_count') + count)
+
+
+# Cette tâche est appelée régulièrement pour prévenir par mail les utilisateurs des photos trouvées après le traitement
+# de leur demande
+@shared_task()
+def task_notify_new_photos():
+    demands_ids = list(Demand.objects.filter(processing_status=Demand.PROCESSED, new_photos_count__gt=0)
+                       .order_by('id').values_list('id', flat=True))
+
+    queue_notifications(task_send_new_photos_notifications, demands_ids)
+
+    return f"{len(demands_ids)} new photos notifications queued"
+
+
+def new_photos_notification_email(demand):
+    """Renvoie le mail qui annonce les nouvelles photos de la demande."""
+    html_content = render_to_string('facereco/mails/mail_new_photos.html',
+                                    {'base_url': settings.BASE_URL, 'demand': demand,
+                                     'new_photos': demand.new_photos_count})
+    txt_content = strip_tags(html_content)
+    email = EmailMultiAlternatives(demand.directory.name + " - De nouvelles photos sont disponibles !", txt_content,
+                                   settings.EMAIL_HOST_USER, [demand.email])
+    email.attach_alternative(html_content, "text/html")
+    return email
+
+
+def new_photos_announced(demand):
+    # On ne retire que les photos annoncées dans le mail, d'autres ont pu être trouvées entre temps
+    Demand.objects.filter(pk=demand.pk).update(new_photos_count=F('new_photos_count') - demand.new_photos_count)
+
+
+"""
+    Cette tâche envoie les mails de nouvelles photos d'un paquet de demandes, sur une seule connexion au serveur de
+    mail.
+
+    Le nombre de nouvelles photos d'une demande n'est remis à zéro qu'une fois son mail envoyé. En cas d'erreur, la
+    tâche est relancée avec les seules demandes dont le mail n'a pas été envoyé.
+    demands_ids : ids des demandes à prévenir
+"""
+@shared_task(bind=True, max_retries=5, rate_limit=settings.NOTIFICATION_RATE_LIMIT or None)
+def task_send_new_photos_notifications(self, demands_ids):
+    demands = Demand.objects.filter(pk__in=demands_ids, processing_status=Demand.PROCESSED, new_photos_count__gt=0)\
+        .select_related('directory').order_by('id')
+
+    sent = send_notifications(self, demands_ids, demands, new_photos_notification_email, new_photos_announced)
+
+    return f"{sent} new photos notifications sent"
+
+
+def start_indexing(dir_id, full_rebuild=False):
+    """
+    Réserve le répertoire puis lance son indexation. Renvoie False si une indexation est déjà en cours ou en attente.
+
+    La réservation (une tâche en cours dans indexing_pending_chunks) est faite par une seule mise à jour conditionnelle
+    avant l'envoi de la tâche : deux clics pendant que task_indexing_directory attend dans la file bulk ne lancent
+    qu'un seul parcours.
+    """
+    indexing = Q(indexing_pending_chunks__gt=0) | Q(total_photos__gt=F('processed_photos') + F('failed_photos'))
+    if Directory.objects.filter(~indexing, pk=dir_id).update(indexing_pending_chunks=1,
+                                                              indexing_last_progress=timezone.now()) == 0:
+        return False
+
+    try:
+        task_indexing_directory.apply_async(args=[dir_id], kwargs={"full_rebuild": full_rebuild})
+    except Exception:
+        Directory.objects.filter(pk=dir_id).update(indexing_pending_chunks=0)
+        raise
+    return True
 
 
 @shared_task(bind=True)
-def task_indexing_directory(self, dir_id):
+def task_indexing_directory(self, dir_id, full_rebuild=False):
     # On récupère le répertoire à indexer
     queryset = Directory.objects.filter(pk=dir_id)
     if len(queryset) != 1:
         raise Exception("Directory not found", {"id": dir_id})
     directory = queryset[0]
     path = directory.path
+    set_directory(dir_id)
+
+    if full_rebuild:
+        # On supprime toutes les entrées dans la base photo qui correspondent à la directory pour tout réindexer
+        indexed_photos = Photo.objects.filter(directory=directory)
+        indexed_photos.delete()
+
+    # Taille et date de modification des photos déjà indexées : seules les photos nouvelles ou modifiées sont encodées,
+    # et on ne supprime que les photos dont le fichier n'existe plus
+    indexed_photos_stats = {}
+    for photo_id, photo_path, file_size, file_mtime in Photo.objects.filter(directory=directory)\
+            .values_list('id', 'path', 'file_size', 'file_mtime').iterator():
+        indexed_photos_stats[photo_path] = (photo_id, file_size, file_mtime)
+
+    # Le travail d'une tâche d'encodage est estimé par la taille des fichiers ; par défaut une tâche traite
+    # l'équivalent de INDEXING_CHUNK_SIZE images de la taille moyenne des photos déjà indexées
+    average_size = Photo.objects.filter(directory=directory).aggregate(Avg('file_size'))['file_size__avg']
+    target_units = target_shard_units(INDEXING, settings.INDEXING_CHUNK_SIZE * (average_size or DEFAULT_IMAGE_SIZE))
+
+    # La date d'indexation est enregistrée avant de lancer l'encodage : elle sert de version à l'index sur disque
+    # construit par task_indexing_ending. Les compteurs augmentent au fur et à mesure du parcours du répertoire.
+    # Le parcours compte pour une tâche d'encodage en cours : l'indexation ne peut pas se terminer avant lui.
+    # Seuls ces champs sont mis à jour : un enregistrement complet écraserait les modifications faites entre temps
+    # (dernière recherche, nom ou visibilité changés dans l'administration...)
+    Directory.objects.filter(pk=dir_id).update(last_indexing_date=timezone.now(), total_photos=0, processed_photos=0,
+                                               failed_photos=0, indexing_pending_chunks=1,
+                                               indexing_last_progress=timezone.now(),
+                                               indexing_task_id=self.request.id)
+
+    # Les tâches d'encodage sont lancées pendant le parcours du répertoire, dès qu'un groupe d'images est complet
+    encoded_images = 0
+    unchanged_images = 0
+
+    def dispatch(imgs_paths):
+        nonlocal unchanged_images
+        Directory.objects.filter(pk=dir_id).update(
+            total_photos=F('total_photos') + len(imgs_paths) + unchanged_images,
+            processed_photos=F('processed_photos') + unchanged_images,
+            indexing_pending_chunks=F('indexing_pending_chunks') + 1,
+            indexing_last_progress=timezone.now())
+        # Les photos inchangées sont comptées : elles ne doivent pas l'être une deuxième fois à la fin du parcours,
+        # même si l'envoi de la tâche échoue
+        unchanged_images = 0
+        try:
+            task_face_encoding_chunk.delay(dir_id, imgs_paths)
+        except Exception:
+            # La tâche n'a pas pu être envoyée : ses images sont comptées en échec
+            finish_indexing_chunk(dir_id, failed_photos=F('failed_photos') + len(imgs_paths))
+            raise
+
+    scan_errors = []
+
+    def imgs_to_encode():
+        nonlocal unchanged_images
+        for img_path, file_size, file_mtime in iter_image_files(path, scan_errors):
+            indexed_photo = indexed_photos_stats.get(img_path)
+            if indexed_photo is not None and indexed_photo[1:] == (file_size, file_mtime):
+                # Les photos qui n'ont pas changé sont déjà indexées
+                del indexed_photos_stats[img_path]
+                unchanged_images += 1
+                continue
+            # Seuls les fichiers nouveaux ou modifiés sont ouverts pour vérifier qu'il s'agit bien d'images. Une photo
+            # indexée remplacée par un autre type de fichier reste dans indexed_photos_stats et sera supprimée.
+            if not is_image_file(img_path):
+                continue
+            indexed_photos_stats.pop(img_path, None)
+            yield img_path, file_size
 
-    # On supprime toutes les entrées dans la base photo qui correspondent à la directory (Cas si on réindexe le répertoire)
-    indexed_photos = Photo.objects.filter(directory=directory)
-    indexed_photos.delete()
+    try:
+        with timer('scan') as stage:
+            for imgs_paths in split_into_shards(imgs_to_encode(), target_units):
+                dispatch(imgs_paths)
+                encoded_images += len(imgs_paths)
+            stage.add(encoded_images)
+
+        # Les photos encore dans indexed_photos_stats n'ont pas été trouvées pendant le parcours. Si une partie du
+        # répertoire n'a pas pu être lue, elles existent peut-être encore : on ne les supprime pas.
+        if len(scan_errors) > 0:
+            logger.warning("Scan of directory %s incomplete (%d errors, first : %s), removed photos are kept",
+                           dir_id, len(scan_errors), scan_errors[0])
+        else:
+            Photo.objects.filter(pk__in=[photo_id for photo_id, _, _ in indexed_photos_stats.values()]).delete()
+    finally:
+        # Fin du parcours, même interrompu par une erreur : la dernière tâche (éventuellement le parcours lui-même)
+        # lance task_indexing_ending
+        finish_indexing_chunk(dir_id, total_photos=F('total_photos') + unchanged_images,
+                              processed_photos=F('processed_photos') + unchanged_images)
 
-    raw_imgs_paths = []
-    for (dirpath, dirnames, filenames) in os.walk(path):
-        raw_imgs_paths.extend([dirpath + '/' + filename for filename in filenames])
+    return encoded_images
 
-    params_list = [(dir_id, img_path) for img_path in raw_imgs_paths]
 
-    chunk = task_face_encoding.chunks(params_list, settings.INDEXING_CHUNK_SIZE)
-    res = chunk.apply_async()
-    res.save()
+# Cette tâche est appelée une fois que toutes les photos du répertoire ont été encodées
+@shared_task()
+def task_indexing_ending(dir_id):
+    try:
+        directory = Directory.objects.get(pk=dir_id)
+    except Directory.DoesNotExist:
+        return "Directory not found : id = {}".format(dir_id)
+    set_directory(dir_id)
 
-    directory.last_indexing_date = timezone.now()
-    directory.total_photos = len(raw_imgs_paths)
-    directory.indexing_task_id = res.id
-    directory.save()
+    # On construit l'index sur disque des visages encodés, utilisé par la recherche vectorisée
+    with timer('index_build') as stage:
+        faces_count = build_directory_index(directory)
+        stage.add(faces_count)
 
-    return len(raw_imgs_paths)
+    return f"Directory n° {dir_id} indexed : {faces_count} faces"
@@ -1,3 +1,141 @@
-from django.test import TestCase
+import threading
+import time
 
-# Create your tests here.
+import numpy
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from django.test import SimpleTestCase, TestCase
+
+from .ann_index import build_ann_index, find_matches_ann
+from .encodings import ENCODING_SIZE
+from .matching import find_matches
+
+
+class TaskQueuesTestCase(TestCase):
+    """
+    Les tâches d'indexation partent dans la file bulk et celles qu'un utilisateur attend dans la file interactive
+    (CELERY_TASK_ROUTES) : un worker qui écoute les deux files traite une tâche interactive sans attendre la fin des
+    tâches d'indexation déjà en attente.
+    """
+
+    BULK_BACKLOG = 10
+
+    def setUp(self):
+        # Application Celery de test avec la configuration du projet, sur un broker en mémoire
+        self.app = Celery('facereco_tests', set_as_current=False)
+        self.app.config_from_object('django.conf:settings', namespace='CELERY')
+        self.app.conf.update(CELERY_BROKER_URL='memory://', CELERY_RESULT_BACKEND='cache+memory://',
+                             CELERY_TASK_ALWAYS_EAGER=False)
+
+        self.completed = []
+        self.all_completed = threading.Event()
+
+        @self.app.task(name='facereco.tests.job', ignore_result=True)
+        def job(name):
+            time.sleep(0.05)
+            self.completed.append(name)
+            if len(self.completed) == self.BULK_BACKLOG + 1:
+                self.all_completed.set()
+
+        self.job = job
+
+    def queue_of(self, task_name):
+        return self.app.amqp.router.route({}, task_name)['queue'].name
+
+    def test_routes(self):
+        for task_name in ('facereco.tasks.task_indexing_directory', 'facereco.tasks.task_face_encoding_chunk',
+                          'facereco.tasks.task_indexing_ending', 'facereco.tasks.task_build_demand_archive'):
+            self.assertEqual(self.queue_of(task_name), 'bulk')
+        for task_name in ('facereco.tasks.encode_demand_photo', 'facereco.tasks.task_search_photos',
+                          'facereco.tasks.task_find_faces', 'facereco.tasks.task_send_search_notifications'):
+            self.assertEqual(self.queue_of(task_name), 'interactive')
+
+    def test_interactive_task_overtakes_bulk_backlog(self):
+        # Une indexation a rempli la file bulk avant qu'une demande n'arrive
+        for i in range(self.BULK_BACKLOG):
+            self.job.apply_async(args=[f'bulk {i}'],
+                                 queue=self.queue_of('facereco.tasks.task_face_encoding_chunk'))
+        self.job.apply_async(args=['interactive'], queue=self.queue_of('facereco.tasks.encode_demand_photo'))
+
+        with start_worker(self.app, concurrency=1, pool='solo', perform_ping_check=False,
+                          queues=['interactive', 'bulk']):
+            self.assertTrue(self.all_completed.wait(timeout=30))
+
+        # Le worker alterne entre les files : la tâche interactive passe avant la fin des tâches d'indexation
+        self.assertLess(self.completed.index('interactive'), 2)
+
+
+def brute_force_matches(demands_encodings, faces_encodings, faces_photo_ids, tolerance):
+    """Correspondances calculées comme face_recognition.compare_faces : une distance par couple demande-visage."""
+    matches = set()
+    for demand_index, demand_encoding in enumerate(demands_encodings):
+        for face_encoding, photo_id in zip(faces_encodings, faces_photo_ids):
+            distance = numpy.linalg.norm(numpy.asarray(face_encoding, dtype=numpy.float64)
+                                         - numpy.asarray(demand_encoding, dtype=numpy.float64))
+            if distance <= tolerance:
+                matches.add((demand_index, int(photo_id)))
+    return sorted(matches)
+
+
+class FindMatchesTestCase(SimpleTestCase):
+    """
+    La recherche par blocs (produit matriciel) et la recherche approximative doivent donner les mêmes correspondances
+    que la comparaison exacte de chaque couple avec FACE_MATCHING_THRESHOLD, y compris à la limite du seuil.
+    """
+
+    TOLERANCE = 0.5
+    # Écarts à la tolérance des visages placés à la limite du seuil, de part et d'autre
+    THRESHOLD_OFFSETS = (-1e-6, -1e-9, -1e-12, 0.0, 1e-12, 1e-9, 1e-6)
+
+    def setUp(self):
+        rng = numpy.random.default_rng(0)
+        self.demands_encodings = rng.normal(0, ENCODING_SIZE ** -0.5, (5, ENCODING_SIZE))
+
+        # Visages aléatoires (loin des demandes), visages proches des demandes et visages à la limite du seuil
+        faces = list(rng.normal(0, ENCODING_SIZE ** -0.5, (200, ENCODING_SIZE)))
+        for demand_encoding in self.demands_encodings:
+            for _ in range(5):
+                faces.append(demand_encoding + rng.normal(0, 0.02, ENCODING_SIZE))
+            for offset in self.THRESHOLD_OFFSETS:
+                direction = rng.normal(size=ENCODING_SIZE)
+                faces.append(demand_encoding + direction / numpy.linalg.norm(direction) * (self.TOLERANCE + offset))
+        order = rng.permutation(len(faces))
+        self.faces_encodings = numpy.array(faces)[order]
+        # Plusieurs visages par photo
+        self.faces_photo_ids = numpy.sort(rng.integers(1, len(faces) // 2, len(faces)))
+
+    def test_near_threshold_faces_exist(self):
+        distances = numpy.linalg.norm(self.faces_encodings[:, None, :] - self.demands_encodings[None, :, :], axis=2)
+        self.assertTrue(numpy.any(numpy.abs(distances - self.TOLERANCE) < 1e-9))
+        self.assertTrue(numpy.any((distances > self.TOLERANCE) & (distances - self.TOLERANCE < 1e-9)))
+
+    def test_same_matches_as_brute_force(self):
+        for dtype in (numpy.float64, numpy.float32):
+            faces_encodings = self.faces_encodings.astype(dtype)
+            expected = brute_force_matches(self.demands_encodings, faces_encodings, self.faces_photo_ids,
+                                           self.TOLERANCE)
+            self.assertGreater(len(expected), 0)
+            # Blocs d'un visage, blocs qui ne divisent pas le nombre de visages, un seul bloc, bloc plus grand
+            for block_size in (1, 7, 64, len(faces_encodings), 4096):
+                with self.subTest(dtype=dtype.__name__, block_size=block_size):
+                    self.assertEqual(find_matches(self.demands_encodings, faces_encodings, self.faces_photo_ids,
+                                                  self.TOLERANCE, block_size), expected)
+
+    def test_no_demand_or_no_face(self):
+        self.assertEqual(find_matches([], self.faces_encodings, self.faces_photo_ids, self.TOLERANCE, 64), [])
+        self.assertEqual(find_matches(self.demands_encodings, numpy.empty((0, ENCODING_SIZE)),
+                                      numpy.empty(0, dtype=numpy.int64), self.TOLERANCE, 64), [])
+
+    def test_ann_matches_are_exact_matches(self):
+        faces_encodings = self.faces_encodings.astype(numpy.float32)
+        expected = find_matches(self.demands_encodings, faces_encodings, self.faces_photo_ids, self.TOLERANCE, 64)
+        ann_index = build_ann_index(faces_encodings, 16, 5)
+
+        for nprobe in (1, 4, 16):
+            with self.subTest(nprobe=nprobe):
+                matches = find_matches_ann(self.demands_encodings, faces_encodings, self.faces_photo_ids, ann_index,
+                                           nprobe, self.TOLERANCE)
+                self.assertTrue(set(matches) <= set(expected))
+                if nprobe == 16:
+                    # Toutes les cellules explorées : même résultat que la recherche exhaustive
+                    self.assertEqual(matches, expected)
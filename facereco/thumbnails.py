@@ -0,0 +1,50 @@
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from PIL import ImageOps
+
+from .face_detection import load_image
+
+THUMBNAIL_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+THUMBNAIL_CONTENT_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+
+def thumbnails_enabled():
+    return settings.THUMBNAIL_SIZE > 0
+
+
+def thumbnail_path(img_path):
+    """Renvoie le chemin de la miniature de l'image img_path (indexée par l'empreinte de son chemin)."""
+    digest = hashlib.sha256(img_path.encode()).hexdigest()
+    return os.path.join(settings.THUMBNAIL_PATH, digest[:2], digest + THUMBNAIL_EXTENSIONS[settings.THUMBNAIL_FORMAT])
+
+
+def save_thumbnail(img_path, image):
+    """
+    Enregistre la miniature de l'image img_path à partir de image, l'image déjà décodée (PIL, RGB) pour l'encodage.
+    Le fichier est écrit sous un nom temporaire puis renommé, la miniature n'est donc jamais lue à moitié écrite.
+    La miniature est redressée d'après l'orientation EXIF de l'image, qui n'est pas enregistrée avec elle.
+    """
+    path = thumbnail_path(img_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    thumbnail = ImageOps.exif_transpose(image)
+    thumbnail.thumbnail((settings.THUMBNAIL_SIZE, settings.THUMBNAIL_SIZE))
+    tmp_path = path + '.' + uuid.uuid4().hex + '.tmp'
+    thumbnail.save(tmp_path, settings.THUMBNAIL_FORMAT, quality=80)
+    os.replace(tmp_path, path)
+    return path
+
+
+def get_thumbnail(img_path):
+    """
+    Renvoie le chemin de la miniature de l'image img_path, en la créant si besoin : les images trouvées dans le cache
+    des encodages ne sont pas décodées pendant l'indexation et n'ont pas encore de miniature.
+    """
+    path = thumbnail_path(img_path)
+    if not os.path.isfile(path):
+        # Décodage directement à taille réduite (mode draft des JPEG)
+        save_thumbnail(img_path, load_image(img_path, settings.THUMBNAIL_SIZE))
+    return path
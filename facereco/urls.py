@@ -5,8 +5,12 @@ from . import views
 urlpatterns = [
     path("", views.index, name="index"),
     path("download/<uuid:request_token>", views.download, name="download"),
+    path("gallery/<uuid:request_token>", views.gallery, name="gallery"),
+    path("gallery/<uuid:request_token>/<int:photo_id>/thumbnail", views.photo_thumbnail, name="photoThumbnail"),
+    path("gallery/<uuid:request_token>/<int:photo_id>/download", views.photo_download, name="photoDownload"),
     path("indexing/<int:directory_id>/", views.indexingDirectory, name="indexingDirectory"),
     path("indexing/<int:directory_id>/progress/", views.indexingDirectoryProgress, name="indexingDirectoryProgress"),
+    path("metrics/", views.metrics, name="metrics"),
     path("forceSearching/<int:directory_id>/", views.forceSearching, name="forceSearching"),
     path("rerunFaceEncoding/<int:demand_id>/", views.rerunFaceEncoding, name="rerunFaceEncoding")
 ]
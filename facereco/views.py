@@ -1,15 +1,19 @@
 import os
-import zipfile
 
 from celery.result import AsyncResult, GroupResult
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models import Q
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse, FileResponse
 from django.shortcuts import render, get_object_or_404
 
+from .archives import iter_zip, get_cached_archive, archive_cache_enabled
 from .forms import DemandForm
+from .metrics import prometheus_metrics
 from .models import Directory, Demand
-from .tasks import task_indexing_directory, encode_demand_photo, task_search_photos
+from .tasks import start_indexing, encode_demand_photo, task_search_photos, task_build_demand_archive
+from .thumbnails import THUMBNAIL_CONTENT_TYPES, get_thumbnail, thumbnails_enabled
 
 
 def index(request):
@@ -34,32 +38,107 @@ def download(request, request_token):
 
     photos = demand.photos.all()
 
+    # Photos choisies dans la galerie (?photo=<id>&photo=<id>...), toutes les photos de la demande par défaut
+    selected_photos_ids = request.GET.getlist('photo')
+    if len(selected_photos_ids) > 0:
+        try:
+            photos = photos.filter(pk__in=[int(photo_id) for photo_id in selected_photos_ids])
+        except ValueError:
+            return HttpResponse("Sélection de photos invalide", status=400)
+
+    photos = list(photos.values_list('id', 'path'))
+
     if len(photos) == 0:
         return HttpResponse("Aucune photo trouvée pour cette demande") #Todo remplacer avec une jolie template
 
-    response = HttpResponse(content_type='application/zip')
+    filename = 'photos_{}'.format(demand.name + ".zip")
 
-    try:
+    # Si l'archive de toutes les photos a déjà été construite, elle est envoyée directement (par le serveur web si
+    # possible)
+    if len(selected_photos_ids) == 0:
+        photos_ids = [photo_id for photo_id, _ in photos]
+        archive_path = get_cached_archive(demand.id, photos_ids)
+        if archive_path is not None:
+            return archive_response(archive_path, filename)
+        if archive_cache_enabled():
+            task_build_demand_archive.delay(demand.id)
 
-        with zipfile.ZipFile(response, 'w') as zf:
-            for photo in photos:
-                zf.write(photo.path, os.path.basename(photo.path))
+    photos_paths = [photo_path for _, photo_path in photos]
 
-    except FileNotFoundError:
+    # Les photos qui n'existent plus sont ignorées
+    photos_paths = [path for path in photos_paths if os.path.isfile(path)]
+    if len(photos_paths) == 0:
         return HttpResponse("Les photos ne sont plus disponibles")  # TODO remplacer avec une jolie template
 
-    response['Content-Disposition'] = 'attachment; filename="photos_{}"'.format(demand.name + ".zip")
+    # L'archive est générée et envoyée au fur et à mesure, sans être construite en mémoire
+    response = StreamingHttpResponse(iter_zip(photos_paths), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
 
     return response
 
 
+def gallery(request, request_token):
+    demand = get_object_or_404(Demand.objects.select_related('directory'), request_token=request_token)
+    if not demand.is_processed:
+        return HttpResponse("La demande n'est pas encore traitée")
+
+    # Les photos sont affichées par pages, à partir de leurs miniatures
+    photos = demand.photos.order_by('id').only('id', 'path')
+    page = Paginator(photos, settings.GALLERY_PAGE_SIZE).get_page(request.GET.get('page'))
+
+    return render(request, "facereco/gallery.html", {"demand": demand, "page": page,
+                                                     "thumbnails": thumbnails_enabled()})
+
+
+def photo_thumbnail(request, request_token, photo_id):
+    demand = get_object_or_404(Demand, request_token=request_token)
+    photo = get_object_or_404(demand.photos, pk=photo_id)
+    if not thumbnails_enabled():
+        raise Http404("Thumbnails disabled")
+
+    try:
+        path = get_thumbnail(photo.path)
+    except OSError:
+        raise Http404("Photo not found")
+
+    response = FileResponse(open(path, 'rb'), content_type=THUMBNAIL_CONTENT_TYPES[settings.THUMBNAIL_FORMAT])
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def photo_download(request, request_token, photo_id):
+    demand = get_object_or_404(Demand, request_token=request_token)
+    photo = get_object_or_404(demand.photos, pk=photo_id)
+    if not os.path.isfile(photo.path):
+        return HttpResponse("La photo n'est plus disponible", status=404)
+
+    return FileResponse(open(photo.path, 'rb'), as_attachment=True, filename=os.path.basename(photo.path))
+
+
+def archive_response(archive_path, filename):
+    if settings.ARCHIVE_SENDFILE_HEADER == "X-Accel-Redirect":
+        # nginx envoie le fichier depuis l'emplacement interne ARCHIVE_SENDFILE_URL_PREFIX
+        response = HttpResponse(content_type='application/zip')
+        response['X-Accel-Redirect'] = settings.ARCHIVE_SENDFILE_URL_PREFIX + os.path.basename(archive_path)
+    elif settings.ARCHIVE_SENDFILE_HEADER == "X-Sendfile":
+        # Apache (mod_xsendfile) envoie le fichier à partir de son chemin
+        response = HttpResponse(content_type='application/zip')
+        response['X-Sendfile'] = archive_path
+    else:
+        response = FileResponse(open(archive_path, 'rb'), content_type='application/zip')
+
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
 @staff_member_required
 def indexingDirectory(request, directory_id):
-    directory = get_object_or_404(Directory, pk=directory_id)
-    if directory.indexing_status == "INDEXING":
-        return HttpResponse("Indexing in progress", status=409)
+    get_object_or_404(Directory, pk=directory_id)
 
-    task_indexing_directory.apply_async(args=[directory_id])
+    # Par défaut seules les photos nouvelles ou modifiées sont encodées, ?full_rebuild=1 réindexe tout le répertoire
+    full_rebuild = request.GET.get("full_rebuild") == "1"
+    if not start_indexing(directory_id, full_rebuild):
+        return HttpResponse("Indexing in progress", status=409)
 
     return HttpResponse("Indexing started")
 
@@ -71,9 +150,15 @@ def indexingDirectoryProgress(request, directory_id):
     return JsonResponse({
         "status": directory.indexing_status,
         "total_photos": directory.total_photos,
-        "indexed_photos": directory.indexed_photos
+        "indexed_photos": directory.indexed_photos,
+        "failed_photos": directory.failed_photos
     })
 
+
+@staff_member_required
+def metrics(request):
+    return HttpResponse(prometheus_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @staff_member_required
 def forceSearching(request, directory_id):
     directory = get_object_or_404(Directory, pk=directory_id)
@@ -81,12 +166,12 @@ def forceSearching(request, directory_id):
         return JsonResponse({'status': 'ERROR', 'message': 'Directory not indexed'})
 
     demands_waiting_for_search = Demand.objects.filter(Q(processing_status=Demand.WAITING_FOR_SEARCH)
-                                                       & Q(face_encoding__isnull=False)
+                                                       & Q(face_encoding_data__isnull=False)
                                                        & Q(directory__pk=directory_id))
     if len(demands_waiting_for_search) == 0:
         return JsonResponse({'status': 'NOTHING_TO_SEARCH', 'message': 'No demand to search'})
 
-    task_search_photos.apply_async(args=[directory_id])
+    task_search_photos.apply_async(args=[directory_id], kwargs={"force": True})
 
     return JsonResponse({'status': 'STARTED', 'message': 'Search started'})
 